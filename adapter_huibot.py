@@ -1,20 +1,297 @@
 import os
-import httpx
+import re
+import time
+import asyncio
+
+import metrics
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-TG_API = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
+TG_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+TG_API = f"{TG_API_BASE}/bot{TELEGRAM_TOKEN}"
+BOT_USERNAME = (os.getenv("BOT_USERNAME") or "").lstrip("@").lower()
+
+# inline: the last reply goes back as the webhook response body ({"method": "sendMessage", ...});
+# api:    every reply is a separate Bot API call before the webhook returns
+REPLY_MODE = (os.getenv("REPLY_MODE") or "inline").strip().lower()
+TG_TIMEOUT = float(os.getenv("TG_TIMEOUT", "8"))
+TG_CONNECT_TIMEOUT = float(os.getenv("TG_CONNECT_TIMEOUT", "3"))
+
+_client = None
+
+def tg_client():
+    """Shared keep-alive client (HTTP/2 when h2 is installed), reused across warm invocations."""
+    global _client
+    if _client is None:
+        import httpx
+        try:
+            import h2  # noqa: F401
+            http2 = True
+        except ImportError:
+            http2 = False
+        _client = httpx.Client(
+            base_url=TG_API,
+            http2=http2,
+            timeout=httpx.Timeout(TG_TIMEOUT, connect=TG_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=8, max_keepalive_connections=4, keepalive_expiry=60),
+        )
+    return _client
+
+def _timed_call(method: str, send):
+    # every outbound Bot API request: latency and HTTP status ("error" if it never got one)
+    t0 = time.perf_counter()
+    status = "error"
+    try:
+        resp = send()
+        status = str(resp.status_code)
+        return resp
+    finally:
+        metrics.record_tg(method, status, time.perf_counter() - t0)
+
+def tg_call(method: str, payload: dict):
+    return _timed_call(method, lambda: tg_client().post(f"/{method}", json=payload))
+
+def _message_payload(chat_id, text, kwargs) -> dict:
+    payload = {"chat_id": chat_id, "text": text}
+    for key, value in kwargs.items():
+        if value is None:
+            continue
+        payload[key] = value.to_dict() if hasattr(value, "to_dict") else value
+    return payload
+
+def send_message(chat_id, text, **kwargs):
+    return tg_call("sendMessage", _message_payload(chat_id, text, kwargs))
+
+def send_document(chat_id, document, filename, caption=None):
+    # multipart upload; `document` is any binary file object (read as the request streams)
+    data = {"chat_id": str(chat_id)}
+    if caption:
+        data["caption"] = caption
+    return _timed_call("sendDocument", lambda: tg_client().post(
+        "/sendDocument", data=data, files={"document": (filename, document)}))
+
+# ---------- Raw-update dispatcher ----------
+# Parses the webhook JSON directly and calls the hui_bot_fresh command functions with
+# light stand-ins for telegram.Update / CallbackContext, so no python-telegram-bot
+# Application is built per request.
+_COMMAND_RE = re.compile(r"^/([A-Za-z0-9_]+)(?:@([A-Za-z0-9_]+))?(?:\s|$)")
+
+class _Chat:
+    __slots__ = ("id", "type")
+    def __init__(self, chat: dict):
+        self.id, self.type = chat["id"], chat.get("type")
+
+class _Document:
+    __slots__ = ("file_id", "file_name", "file_size", "mime_type")
+    def __init__(self, doc: dict):
+        self.file_id = doc["file_id"]
+        self.file_name = doc.get("file_name")
+        self.file_size = doc.get("file_size")
+        self.mime_type = doc.get("mime_type")
+
+class _Message:
+    __slots__ = ("chat", "message_id", "text", "caption", "document", "_calls")
+    def __init__(self, msg: dict, calls: list):
+        self.chat = _Chat(msg["chat"])
+        self.message_id = msg.get("message_id")
+        self.text = msg.get("text") or ""
+        self.caption = msg.get("caption")
+        self.document = _Document(msg["document"]) if msg.get("document") else None
+        self._calls = calls
+
+    async def reply_text(self, text, **kwargs):
+        self._calls.append(("sendMessage", _message_payload(self.chat.id, text, kwargs)))
+
+    async def reply_document(self, document, filename=None, caption=None, **kwargs):
+        # an upload cannot ride on the webhook response: send earlier replies, then upload now
+        for method, payload in self._calls:
+            tg_call(method, payload)
+        self._calls.clear()
+        resp = send_document(self.chat.id, document, filename or "file", caption)
+        if resp.status_code != 200:
+            raise RuntimeError(f"sendDocument {resp.status_code}: {resp.text[:200]}")
 
-def send_message(chat_id, text):
-    httpx.get(f"{TG_API}/sendMessage", params={
-        "chat_id": chat_id,
-        "text": text
-    })
+class _CallbackQuery:
+    __slots__ = ("id", "data", "message", "_calls")
+    def __init__(self, query: dict, calls: list):
+        self.id = query["id"]
+        self.data = query.get("data") or ""
+        self.message = _Message(query["message"], calls)
+        self._calls = calls
+
+    async def answer(self, text=None, **kwargs):
+        payload = {"callback_query_id": self.id, **kwargs}
+        if text:
+            payload["text"] = text
+        self._calls.append(("answerCallbackQuery", payload))
+
+    async def edit_message_text(self, text, **kwargs):
+        payload = _message_payload(self.message.chat.id, text, kwargs)
+        payload["message_id"] = self.message.message_id
+        self._calls.append(("editMessageText", payload))
+
+class _Update:
+    __slots__ = ("update_id", "message", "callback_query", "effective_chat", "calls")
+    def __init__(self, update: dict):
+        self.update_id = update.get("update_id")
+        self.calls = []     # [(method, payload)] in the order the handler made them
+        if "callback_query" in update:
+            self.callback_query = _CallbackQuery(update["callback_query"], self.calls)
+            self.message = self.callback_query.message
+        else:
+            self.callback_query = None
+            self.message = _Message(update["message"], self.calls)
+        self.effective_chat = self.message.chat
+
+class _File:
+    __slots__ = ("file_id", "file_path", "file_size")
+    def __init__(self, result: dict):
+        self.file_id = result["file_id"]
+        self.file_path = result.get("file_path")
+        self.file_size = result.get("file_size")
+
+    async def download_as_bytearray(self):
+        r = _timed_call("file", lambda: tg_client().get(f"{TG_API_BASE}/file/bot{TELEGRAM_TOKEN}/{self.file_path}"))
+        r.raise_for_status()
+        return bytearray(r.content)
+
+class _Bot:
+    # the ctx.bot calls handlers make besides replying
+    async def get_file(self, file_id):
+        body = tg_call("getFile", {"file_id": file_id}).json()
+        if not body.get("ok"):
+            raise RuntimeError(body.get("description") or "getFile failed")
+        return _File(body["result"])
+
+class _Context:
+    __slots__ = ("args", "bot")
+    def __init__(self, args):
+        self.args = args
+        self.bot = _Bot()
+
+_bot = None
+_dedupe = None
+_loop = None
+
+def _bot_module():
+    # imported on first command, then reused by warm invocations
+    global _bot
+    if _bot is None:
+        import hui_bot_fresh
+        _bot = hui_bot_fresh
+    return _bot
+
+def _dedupe_module():
+    global _dedupe
+    if _dedupe is None:
+        import idempotency
+        _dedupe = idempotency
+    return _dedupe
+
+def _run(coro):
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coro)
+
+def route_callback(data: str):
+    """Handler for an inline-keyboard callback_data ("<prefix>:..."), or None."""
+    return _bot_module().CALLBACKS.get(data.split(":", 1)[0])
+
+def route(text: str):
+    """Return (handler, args) for a message text, or (None, None) when it is not for us."""
+    bot = _bot_module()
+    m = _COMMAND_RE.match(text)
+    if not m:
+        return bot.handle_text, []
+    name, mention = m.group(1).lower(), (m.group(2) or "").lower()
+    if mention and BOT_USERNAME and mention != BOT_USERNAME:
+        return None, None
+    handler = bot.COMMANDS.get(name)
+    if handler is None:
+        return bot.handle_text, []
+    return handler, text.split()[1:]
+
+async def _dispatch(upd: _Update, handler, args):
+    bot = _bot_module()
+    import psycopg2
+    from db_pg import inline_db
+    try:
+        # one update per invocation: DB calls run inline instead of hopping to the thread pool.
+        # The whole update is one transaction, so a handler that fails has written nothing.
+        with metrics.command(handler.__name__), bot.unit_of_work(transaction=True), inline_db():
+            await handler(upd, _Context(args))
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # transient (connection lost, deadlock, serialization): rolled back, so handle_update
+        # releases the claim and fails the webhook and Telegram redelivers the update
+        raise
+    except Exception as e:
+        # details stay in the log; users get a generic message (no SQL/internals in chat)
+        print("❌ Command error:", repr(e))
+        upd.calls.clear()
+        await upd.message.reply_text("❌ Có lỗi xảy ra, vui lòng thử lại sau.")
 
 def handle_update(update):
-    if "message" in update:
-        chat_id = update["message"]["chat"]["id"]
-        text = update["message"].get("text", "")
+    """Run the update; returns a Bot API method dict to use as the webhook response, or None."""
+    query = update.get("callback_query")
+    if query:
+        if not query.get("message") or not query.get("data"):
+            return None
+        handler, args = route_callback(query["data"]), []
+    else:
+        msg = update.get("message")
+        if not msg:
+            return None
+        if "text" in msg:
+            handler, args = route(msg["text"])
+        elif msg.get("document") and (msg.get("caption") or "").startswith("/"):
+            handler, args = route(msg["caption"])     # file + command caption (/nhap)
+        else:
+            return None
+    if handler is None:
+        return None
+    _bot_module().ensure_schema()     # one version check per warm instance
+    update_id = update.get("update_id")
+    if update_id is not None and not _dedupe_module().claim(update_id):
+        return None     # Telegram redelivery: already handled, ack without side effects
+    upd = _Update(update)
+    try:
+        _run(_dispatch(upd, handler, args))
+    except Exception:
+        # only a rolled-back update gets here: nothing was written, let Telegram redeliver it
+        if update_id is not None:
+            _dedupe_module().release(update_id)
+        raise
+    # committed: the claim stays, whatever happens to the replies
+    return _deliver(upd.calls)
+
+def _send_best_effort(method: str, payload: dict):
+    # a reply that cannot go out now must not fail the webhook (the redelivery would run the
+    # command twice); messages go to the outbox instead, other calls are only logged
+    try:
+        resp = tg_call(method, payload)
+        if resp.status_code == 200:
+            return
+        retry, error = resp.status_code == 429 or resp.status_code >= 500, f"{resp.status_code}: {resp.text[:200]}"
+    except Exception as e:
+        retry, error = True, repr(e)
+    if retry and method == "sendMessage":
+        try:
+            from outbox import enqueue
+            enqueue(payload["chat_id"], payload["text"])
+            return
+        except Exception as e:
+            error += f"; outbox: {e!r}"
+    print(f"❌ {method} not delivered:", error)
 
-        # Gửi phản hồi
-        reply = f"Bạn nói: {text}"
-        send_message(chat_id, reply)
+def _deliver(calls: list):
+    if not calls:
+        return None
+    inline = REPLY_MODE == "inline"
+    # earlier calls go out now; the inline one is delivered after we return, so order is kept
+    # (for callbacks: answerCallbackQuery now, editMessageText inline)
+    for method, payload in (calls[:-1] if inline else calls):
+        _send_best_effort(method, payload)
+    if not inline:
+        return None
+    method, payload = calls[-1]
+    return {"method": method, **payload}
@@ -1,9 +1,25 @@
-from flask import Flask, request, jsonify
-import os, httpx
+from flask import Flask, request, jsonify, g, Response
+import os
+import metrics
 from adapter_huibot import handle_update
 
 app = Flask(__name__)
 
+# ----- instrumentation: one trace + structured log line per request -----
+@app.before_request
+def _trace_begin():
+    # label by route template, not raw path: scan/404 paths must not grow new series
+    rule = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    if rule != "/api/metrics":                  # scrapes are not traffic
+        g.trace = metrics.begin(route=rule)
+
+@app.after_request
+def _trace_end(resp):
+    token = g.pop("trace", None)
+    if token is not None:
+        metrics.end(token, status=resp.status_code)
+    return resp
+
 @app.get("/api/healthz")
 def healthz():
     return jsonify({"ok": True, "msg": "online"})
@@ -12,16 +28,77 @@ def healthz():
 def root():
     return jsonify({"ok": True})
 
+def _cron_authorized() -> bool:
+    # Vercel Cron sends "Authorization: Bearer $CRON_SECRET" when CRON_SECRET is set
+    secret = os.getenv("CRON_SECRET")
+    return not secret or request.headers.get("Authorization") == f"Bearer {secret}"
+
+@app.get("/api/metrics")
+def metrics_endpoint():
+    # Prometheus text format; counters are per instance (see metrics.py)
+    if not _cron_authorized():
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 @app.post("/api/webhook")
 def webhook():
     try:
         update = request.get_json(force=True)
-        handle_update(update)
-        return jsonify({"ok": True})
+        reply = handle_update(update)
+        # REPLY_MODE=inline: Telegram executes this method from the response body
+        return jsonify(reply or {"ok": True})
     except Exception as e:
         print("❌ Webhook error:", e)
         return jsonify({"ok": False, "error": str(e)}), 500
 
+@app.get("/api/cron/reminders")
+def cron_reminders():
+    if not _cron_authorized():
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    try:
+        from db_pg import ensure_schema
+        from reminders import run_reminders, REMINDER_MAX_SECONDS
+        from outbox import drain
+        ensure_schema()
+        stats = run_reminders()
+        stats["outbox"] = drain(max(1.0, REMINDER_MAX_SECONDS - stats.get("ms", 0) / 1000))
+        print("⏰ Reminders:", stats)
+        return jsonify({"ok": True, **stats})
+    except Exception as e:
+        print("❌ Reminders error:", repr(e))
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+@app.get("/api/cron/outbox")
+def cron_outbox():
+    if not _cron_authorized():
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    try:
+        from db_pg import ensure_schema
+        from outbox import drain
+        ensure_schema()
+        stats = drain()
+        print("📤 Outbox:", stats)
+        return jsonify({"ok": True, **stats})
+    except Exception as e:
+        print("❌ Outbox error:", repr(e))
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+@app.get("/api/cron/monthly")
+def cron_monthly():
+    if not _cron_authorized():
+        return jsonify({"ok": False, "error": "unauthorized"}), 401
+    try:
+        from db_pg import ensure_schema
+        from reports import run_monthly, parse_month
+        ensure_schema()
+        month = request.args.get("month")
+        stats = run_monthly(force=request.args.get("force") == "1", month=parse_month(month) if month else None)
+        print("📊 Monthly:", stats)
+        return jsonify({"ok": True, **stats})
+    except Exception as e:
+        print("❌ Monthly error:", repr(e))
+        return jsonify({"ok": False, "error": str(e)}), 500
+
 @app.get("/api/register-webhook")
 def register_webhook():
     try:
@@ -32,6 +109,7 @@ def register_webhook():
         if not token or not base_url:
             raise ValueError("Missing TELEGRAM_TOKEN or PUBLIC_URL")
 
+        import httpx
         webhook_url = f"{base_url}/api/webhook"
         resp = httpx.get(
             f"https://api.telegram.org/bot{token}/setWebhook",
@@ -50,6 +128,7 @@ def test_getme():
         token = os.getenv("TELEGRAM_TOKEN")
         if not token:
             raise ValueError("Missing TELEGRAM_TOKEN")
+        import httpx
         r = httpx.get(f"https://api.telegram.org/bot{token}/getMe", timeout=10)
         print("🔎 getMe raw:", r.status_code, r.text)
         return jsonify(r.json())
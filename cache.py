@@ -0,0 +1,79 @@
+# ===================== cache.py =====================
+# Process-local read-through cache (size-bounded LRU + TTL), shared by warm invocations.
+# Entries may carry a version: once the TTL has passed, callers can revalidate with a
+# cheap version lookup instead of reloading the whole value.
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name, self.maxsize, self.ttl = name, maxsize, ttl
+        self._data: "OrderedDict[Hashable, list]" = OrderedDict()   # key -> [value, version, expires_at]
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "stale": 0, "evictions": 0, "invalidations": 0}
+
+    def _put(self, key, value, version, now):
+        self._data[key] = [value, version, now + self.ttl]
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def put(self, key, value, version=None):
+        with self._lock:
+            self._put(key, value, version, time.monotonic())
+
+    def get_or_load(self, key, load: Callable[[], Any], version_of: Optional[Callable[[], Any]] = None):
+        """Cached value for key; load() on miss. After the TTL, version_of() (if given)
+        decides between extending the entry and reloading it."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                if now < entry[2]:
+                    self.stats["hits"] += 1
+                    return entry[0]
+        if entry is not None and version_of is not None and entry[1] is not None:
+            if version_of() == entry[1]:
+                with self._lock:
+                    entry[2] = now + self.ttl
+                    self.stats["revalidated"] += 1
+                return entry[0]
+            self.stats["stale"] += 1
+        else:
+            self.stats["misses"] += 1
+        value, version = load()
+        if value is not None:
+            self.put(key, value, version)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def snapshot_stats(self) -> Dict[str, Any]:
+        s = self.stats
+        served = s["hits"] + s["revalidated"]
+        total = served + s["misses"] + s["stale"]
+        with self._lock:
+            size = len(self._data)
+        return {**s, "size": size, "hit_ratio": (served / total if total else 0.0)}
+
+# ----- named caches -----
+# TTL 0 (default) revalidates every read by version: a warm instance never serves a value
+# another instance has since changed; the win is skipping the full load, not the round trip
+line_cache = TTLCache("lines", int(os.getenv("LINE_CACHE_SIZE", "2048")), float(os.getenv("LINE_CACHE_TTL", "0")))
+cfg_cache  = TTLCache("cfg", 64, float(os.getenv("CFG_CACHE_TTL", "0")))
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {c.name: c.snapshot_stats() for c in (line_cache, cfg_cache)}
@@ -1,88 +1,341 @@
-
 import os
+import copy
 import json
+import time
+import itertools
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
 import psycopg2
 import psycopg2.extras
 
+import metrics
+from cache import cfg_cache
+
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
-if not DATABASE_URL:
-    raise SystemExit("Missing DATABASE_URL (Neon Postgres) in environment variables")
+DB_SSLMODE   = os.getenv("DB_SSLMODE", "require").strip()   # Neon needs SSL; "" leaves it to the URL
+
+def _dsn() -> str:
+    # checked on first connect, not at import, so cold starts that never touch the DB stay cheap
+    if not DATABASE_URL:
+        raise RuntimeError("Missing DATABASE_URL (Neon Postgres) in environment variables")
+    return DATABASE_URL
+
+# ----- Instrumentation: every cursor.execute is timed into metrics -----
+class _TimedCursor:
+    def execute(self, query, vars=None):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_db(time.perf_counter() - t0)
+
+@functools.lru_cache(maxsize=None)
+def _timed(factory):
+    return type(f"Timed{factory.__name__}", (_TimedCursor, factory), {})
+
+class _MeteredConnection(psycopg2.extensions.connection):
+    # wraps whichever cursor class the caller asks for (RealDictCursor, named cursors, ...)
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _timed(factory)
+        return super().cursor(*args, **kwargs)
+
+def _open():
+    t0 = time.perf_counter()
+    ssl = {"sslmode": DB_SSLMODE} if DB_SSLMODE else {}
+    conn = psycopg2.connect(_dsn(), connection_factory=_MeteredConnection, **ssl)
+    metrics.record_connect(time.perf_counter() - t0)
+    return conn
+
+# ----- Pool settings (module-level pool survives warm serverless invocations) -----
+POOL_SIZE          = int(os.getenv("DB_POOL_SIZE", "4"))            # idle connections kept
+POOL_IDLE_TIMEOUT  = float(os.getenv("DB_IDLE_TIMEOUT", "240"))     # s; Neon suspends compute ~5 min
+POOL_CHECK_AFTER   = float(os.getenv("DB_HEALTHCHECK_AFTER", "30")) # s idle before a SELECT 1 probe
+
+class _Pool:
+    """Small LIFO pool of autocommit connections with stale detection."""
+    def __init__(self, size: int, idle_timeout: float, check_after: float):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._idle = []                      # [(conn, last_used_monotonic)]
+        self._lock = threading.Lock()
+        self.stats = {"connects": 0, "reuses": 0, "stale_dropped": 0,
+                      "health_failures": 0, "discarded": 0}
+
+    def _connect(self):
+        conn = _open()
+        conn.autocommit = True
+        self.stats["connects"] += 1
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try: conn.close()
+        except Exception: pass
+
+    def _healthy(self, conn, idle_for: float) -> bool:
+        if conn.closed:
+            return False
+        if idle_for < self.check_after:
+            return True
+        try:
+            cur = conn.cursor(); cur.execute("SELECT 1"); cur.close()
+            return True
+        except Exception:
+            self.stats["health_failures"] += 1
+            return False
+
+    def acquire(self):
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last = self._idle.pop()
+            idle_for = now - last
+            if idle_for > self.idle_timeout or not self._healthy(conn, idle_for):
+                self.stats["stale_dropped"] += 1
+                self._close(conn)
+                continue
+            self.stats["reuses"] += 1
+            return conn
+        return self._connect()
+
+    def release(self, conn, broken: bool = False):
+        if broken or conn.closed or conn.status != psycopg2.extensions.STATUS_READY:
+            self.stats["discarded"] += 1
+            self._close(conn)
+            return
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        self._close(conn)
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+_pool = _Pool(POOL_SIZE, POOL_IDLE_TIMEOUT, POOL_CHECK_AFTER)
+_current_conn = contextvars.ContextVar("huibot_db_conn", default=None)
+
+def pool_stats() -> dict:
+    with _pool._lock:
+        idle = len(_pool._idle)
+    return {**_pool.stats, "idle": idle, "size": _pool.size}
+
+@contextmanager
+def connection():
+    """Yield a pooled connection (or the one pinned by an active unit_of_work)."""
+    pinned = _current_conn.get()
+    if pinned is not None:
+        yield pinned
+        return
+    conn = _pool.acquire()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        _pool.release(conn, broken=broken)
+
+@contextmanager
+def _transaction(conn):
+    conn.autocommit = False
+    try:
+        yield
+        conn.commit()
+    except BaseException:               # incl. GeneratorExit from an abandoned stream_rows
+        if not conn.closed:
+            try: conn.rollback()
+            except Exception: pass
+        raise
+    finally:
+        if not conn.closed:
+            conn.autocommit = True
+
+@contextmanager
+def unit_of_work(transaction: bool = False):
+    """Pin one connection for every helper call inside the block.
+
+    With transaction=True the block runs in a single transaction that is
+    committed on success and rolled back on error (also when nested inside a
+    plain unit_of_work; inside a transaction it joins the outer one).
+    """
+    pinned = _current_conn.get()
+    if pinned is not None:
+        if transaction and pinned.autocommit:
+            with _transaction(pinned):
+                yield pinned
+        else:
+            yield pinned
+        return
+    with connection() as conn:
+        token = _current_conn.set(conn)
+        try:
+            if transaction:
+                with _transaction(conn):
+                    yield conn
+            else:
+                yield conn
+        finally:
+            _current_conn.reset(token)
 
 def db():
-    # Autocommit for serverless simplicity
-    conn = psycopg2.connect(DATABASE_URL, sslmode="require")
+    # Raw connection outside the pool (caller closes it)
+    conn = _open()
     conn.autocommit = True
     return conn
 
-def init_db():
-    conn = db()
-    cur = conn.cursor()
-    # lines
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS lines(
-        id           BIGSERIAL PRIMARY KEY,
-        name         TEXT NOT NULL,
-        period_days  INTEGER NOT NULL,
-        start_date   DATE NOT NULL,
-        legs         INTEGER NOT NULL,
-        contrib      BIGINT NOT NULL,
-        bid_type     TEXT DEFAULT 'dynamic',
-        bid_value    DOUBLE PRECISION DEFAULT 0,
-        status       TEXT DEFAULT 'OPEN',
-        created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-        base_rate    DOUBLE PRECISION DEFAULT 0,
-        cap_rate     DOUBLE PRECISION DEFAULT 100,
-        thau_rate    DOUBLE PRECISION DEFAULT 0,
-        remind_hour  INTEGER DEFAULT 8,
-        remind_min   INTEGER DEFAULT 0,
-        last_remind_iso DATE
-    );
-    """)
-    # payments
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS payments(
-        id BIGSERIAL PRIMARY KEY,
-        line_id BIGINT NOT NULL REFERENCES lines(id) ON DELETE CASCADE,
-        pay_date DATE NOT NULL,
-        amount   BIGINT NOT NULL
-    );
-    """)
-    # rounds
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS rounds(
-        id BIGSERIAL PRIMARY KEY,
-        line_id BIGINT NOT NULL REFERENCES lines(id) ON DELETE CASCADE,
-        k       INTEGER NOT NULL,
-        bid     BIGINT NOT NULL,
-        round_date DATE,
-        UNIQUE(line_id, k)
-    );
-    """)
-    # configs (key/value JSONB)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS configs(
-        key   TEXT PRIMARY KEY,
-        value JSONB NOT NULL
-    );
-    """)
-    cur.close()
-    conn.close()
+# ----- Query helpers -----
+def get_all(query: str, params: tuple = ()):
+    with connection() as conn:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        cur.close()
+    return rows
+
+def exec_sql(query: str, params: tuple = ()):
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        cur.close()
+
+def insert_and_get_id(query: str, params: tuple = ()):
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(query + " RETURNING id", params)
+        new_id = cur.fetchone()[0]
+        cur.close()
+    return new_id
+
+# ----- Async access (polling mode) -----
+# psycopg2 blocks, so async handlers hop onto a small bounded thread pool; the caller's
+# context (its unit_of_work connection) goes along. inline_db() skips the hop where
+# nothing else shares the event loop (the webhook dispatcher runs one update at a time).
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "8"))
+
+_executor = None
+_executor_lock = threading.Lock()
+_inline = contextvars.ContextVar("db_inline", default=False)
+
+def _db_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    return _executor
+
+@contextmanager
+def inline_db():
+    token = _inline.set(True)
+    try:
+        yield
+    finally:
+        _inline.reset(token)
+
+async def run_db(fn, *args, **kwargs):
+    """await the blocking DB call fn(*args, **kwargs) without stalling the event loop."""
+    if _inline.get():
+        return fn(*args, **kwargs)
+    import asyncio
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(_db_executor(), call)
+
+async def aget_all(query: str, params: tuple = ()):
+    return await run_db(get_all, query, params)
+
+async def aexec_sql(query: str, params: tuple = ()):
+    return await run_db(exec_sql, query, params)
+
+async def ainsert_and_get_id(query: str, params: tuple = ()):
+    return await run_db(insert_and_get_id, query, params)
+
+@asynccontextmanager
+async def aunit_of_work():
+    """unit_of_work for async code: the connection is acquired and released on the DB threads."""
+    if _current_conn.get() is not None:
+        yield _current_conn.get()
+        return
+    conn = await run_db(_pool.acquire)
+    token = _current_conn.set(conn)
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        _current_conn.reset(token)
+        await run_db(_pool.release, conn, broken)
+
+_stream_ids = itertools.count(1)
+
+def stream_rows(query: str, params=(), chunk: int = 1000):
+    """Yield row tuples from a server-side (named) cursor, `chunk` rows per round trip.
+
+    Memory stays flat however many rows match; runs in its own transaction
+    (named cursors need one) unless an outer transaction is already open.
+    """
+    with unit_of_work(transaction=True) as conn:
+        cur = conn.cursor(name=f"stream_{next(_stream_ids)}")
+        cur.itersize = chunk
+        try:
+            cur.execute(query, params)
+            yield from cur
+        finally:
+            cur.close()
+
+# ----- Schema -----
+_schema_ok = False
+_schema_lock = threading.Lock()
 
 def ensure_schema():
-    # For now schema is fully created in init_db
-    return
+    """Bring the schema to the latest migration, once per process (see migrations.py).
+
+    A current schema costs one SELECT; only a cold start that finds pending steps
+    takes the advisory lock and runs DDL.
+    """
+    global _schema_ok
+    if _schema_ok:
+        return
+    with _schema_lock:
+        if not _schema_ok:
+            from migrations import migrate
+            migrate()
+            _schema_ok = True
+
+def init_db():
+    ensure_schema()
+
+_CFG_MISSING = object()
+
+def _cfg_load(key: str):
+    rows = get_all("SELECT value, version FROM configs WHERE key=%s", (key,))
+    return (rows[0]["value"], rows[0]["version"]) if rows else (_CFG_MISSING, None)
+
+def _cfg_version(key: str):
+    rows = get_all("SELECT version FROM configs WHERE key=%s", (key,))
+    return rows[0]["version"] if rows else None
 
 def cfg_get(key: str, default=None):
-    conn = db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute("SELECT value FROM configs WHERE key=%s", (key,))
-    row = cur.fetchone()
-    cur.close(); conn.close()
-    return (row["value"] if row else default)
+    # cached per instance, revalidated by configs.version after CFG_CACHE_TTL;
+    # callers get their own copy to mutate
+    value = cfg_cache.get_or_load(key, lambda: _cfg_load(key), lambda: _cfg_version(key))
+    return default if value is _CFG_MISSING else copy.deepcopy(value)
 
 def cfg_set(key: str, value):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO configs(key,value) VALUES(%s,%s) ON CONFLICT(key) DO UPDATE SET value=EXCLUDED.value",
-                (key, json.dumps(value, ensure_ascii=False)))
-    cur.close(); conn.close()
+    exec_sql("INSERT INTO configs(key,value) VALUES(%s,%s) "
+             "ON CONFLICT(key) DO UPDATE SET value=EXCLUDED.value, version=configs.version+1",
+             (key, json.dumps(value, ensure_ascii=False)))
+    cfg_cache.invalidate(key)
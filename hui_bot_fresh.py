@@ -1,28 +1,38 @@
-
 # ===================== hui_bot_fresh.py (Neon Postgres) =====================
 # Telegram Hui Bot — Webhook-first, Serverless-friendly
-# Dependencies: python-telegram-bot==20.3, pandas, psycopg2-binary
-import os, json, asyncio, random, re, unicodedata
+# Dependencies: python-telegram-bot==20.3, psycopg2-binary (numpy optional, see payout_engine)
+# telegram.ext is imported only by main() (polling); the webhook path never loads it.
+from __future__ import annotations
+import os, sys, csv, io, json, asyncio, random, re, unicodedata, weakref
 from datetime import datetime, timedelta, time as dtime
-from typing import Optional, Tuple, Dict, List, Any
+from typing import Optional, Tuple, Dict, List, Any, TYPE_CHECKING
 
-import pandas as pd
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from telegram.ext import (
-    ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler, filters
-)
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
-from db_pg import db, init_db, ensure_schema, cfg_get, cfg_set
+from payout_engine import payout_table, best_k
+from cache import line_cache
+import metrics
+from db_pg import (
+    init_db, ensure_schema, cfg_get, cfg_set, get_all, exec_sql, insert_and_get_id, unit_of_work,
+    run_db, aunit_of_work
+)
 
 # ========= CONFIG =========
 TOKEN = (os.getenv("TELEGRAM_TOKEN") or os.getenv("BOT_TOKEN") or "").strip()
-if not TOKEN:
-    raise SystemExit("Missing TELEGRAM_TOKEN/BOT_TOKEN in environment variables")
 
 REPORT_HOUR = 8                 # 08:00 gửi báo cáo tháng (chỉ mùng 1)
 REMINDER_TICK_SECONDS = 60      # vòng lặp check nhắc hẹn
 
 ISO_FMT = "%Y-%m-%d"   # lưu DB
+TG_TEXT_LIMIT  = 4096   # giới hạn ký tự 1 tin nhắn Telegram
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "15"))   # /danhsach: số dây mỗi trang
+BOT_TZ  = os.getenv("BOT_TZ", "Asia/Ho_Chi_Minh")   # giờ nhắc/báo cáo theo giờ địa phương
+IMPORT_MAX_BYTES  = int(os.getenv("IMPORT_MAX_BYTES", str(512 * 1024)))   # /nhap: file CSV tối đa
+IMPORT_MAX_ROWS   = int(os.getenv("IMPORT_MAX_ROWS", "5000"))
+IMPORT_MAX_ERRORS = 30   # số dòng lỗi liệt kê trong 1 phản hồi
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))   # polling: updates xử lý song song
 
 # ====== UTIL ======
 def strip_accents(s: str) -> str:
@@ -49,12 +59,59 @@ def parse_user_date(s: str) -> datetime:
     d, m, y = _smart_parse_dmy(s)
     return datetime(y, m, d)
 
+def parse_any_date(s: str) -> datetime:
+    # DD-MM-YYYY (chat) or YYYY-MM-DD (spreadsheets)
+    s = s.strip()
+    return parse_iso(s.replace("/", "-")) if re.match(r"^\d{4}[-/]\d{1,2}[-/]\d{1,2}$", s) else parse_user_date(s)
+
 def to_iso_str(d: datetime) -> str:
     return d.strftime(ISO_FMT)
 
 def to_user_str(d: datetime) -> str:
     return d.strftime("%d-%m-%Y")
 
+def now_local() -> datetime:
+    # naive datetime in BOT_TZ (serverless hosts run in UTC)
+    try:
+        from zoneinfo import ZoneInfo
+        tz = ZoneInfo(BOT_TZ)
+    except Exception:
+        from datetime import timezone
+        tz = timezone(timedelta(hours=7))
+    return datetime.now(tz).replace(tzinfo=None)
+
+def split_message(text: str, limit: int = TG_TEXT_LIMIT) -> List[str]:
+    # cut at line boundaries; a single line longer than the limit is hard-cut
+    if len(text) <= limit:
+        return [text]
+    out, cur = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if cur: out.append(cur); cur = ""
+            out.append(line[:limit]); line = line[limit:]
+        if cur and len(cur) + 1 + len(line) > limit:
+            out.append(cur); cur = ""
+        cur = f"{cur}\n{line}" if cur else line
+    if cur: out.append(cur)
+    return out
+
+async def reply_long(upd: Update, text: str, **kwargs):
+    # long replies go out as several messages; reply_markup stays on the last one
+    parts = split_message(text)
+    for i, part in enumerate(parts):
+        await upd.message.reply_text(part, **(kwargs if i == len(parts) - 1 else {}))
+
+def inline_kb(rows: List[List[Tuple[str, str]]]):
+    """Inline keyboard from [[(text, callback_data), ...], ...].
+
+    Polling mode (telegram already imported) gets python-telegram-bot objects; the
+    webhook dispatcher gets the plain Bot API dict and never imports telegram.
+    """
+    if "telegram" in sys.modules:
+        from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+        return InlineKeyboardMarkup([[InlineKeyboardButton(t, callback_data=d) for t, d in row] for row in rows])
+    return {"inline_keyboard": [[{"text": t, "callback_data": d} for t, d in row] for row in rows]}
+
 # ----- MONEY PARSER -----
 def parse_money(text: str) -> int:
     s = str(text).strip().lower().replace(",", "").replace("_", "").replace(" ", "").replace(".", "")
@@ -70,30 +127,7 @@ def parse_money(text: str) -> int:
 
 # ---------- DB Logic ----------
 def init_tables_if_needed():
-    init_db(); ensure_schema()
-
-def get_all(query: str, params: tuple = ()):
-    import psycopg2.extras
-    conn = db()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute(query, params)
-    rows = cur.fetchall()
-    cur.close(); conn.close()
-    return rows
-
-def exec_sql(query: str, params: tuple = ()):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(query, params)
-    cur.close(); conn.close()
-
-def insert_and_get_id(query: str, params: tuple = ()):
-    conn = db()
-    cur = conn.cursor()
-    cur.execute(query + " RETURNING id", params)
-    new_id = cur.fetchone()[0]
-    cur.close(); conn.close()
-    return new_id
+    ensure_schema()
 
 def load_cfg() -> dict:
     return cfg_get("bot_cfg", {}) or {}
@@ -108,10 +142,6 @@ def k_date(line, k: int) -> datetime:
 def roi_to_str(r: float) -> str:
     return f"{r*100:.2f}%"
 
-def get_bids(line_id: int):
-    rows = get_all("SELECT k, bid FROM rounds WHERE line_id=%s ORDER BY k", (line_id,))
-    return {int(r["k"]): int(r["bid"]) for r in rows}
-
 def payout_at_k(line, bids: dict, k: int) -> int:
     M, N = int(line["contrib"]), int(line["legs"])
     T_k = int(bids.get(k, 0))
@@ -131,27 +161,220 @@ def compute_profit_var(line, k: int, bids: dict):
     return profit, roi, po, paid
 
 def best_k_var(line, bids: dict, metric="roi"):
-    bestk, bestkey, bestinfo = 1, -1e18, None
-    for k in range(1, int(line["legs"]) + 1):
-        p, r, po, paid = compute_profit_var(line, k, bids)
-        key = r if metric == "roi" else p
-        if key > bestkey:
-            bestk, bestkey, bestinfo = k, key, (p, r, po, paid)
-    return bestk, bestinfo
+    # O(N) prefix-sum engine; same result as looping compute_profit_var over k
+    return best_k(line, bids, metric)
 
 def is_finished(line) -> bool:
     if line["status"] == "CLOSED": return True
     last = k_date(line, int(line["legs"])).date()
-    return datetime.now().date() >= last
+    return now_local().date() >= last
 
-def load_line_full(line_id: int):
-    rows = get_all("SELECT * FROM lines WHERE id=%s", (line_id,))
-    if not rows:
-        return None, pd.DataFrame()
-    line = rows[0]
-    pays = get_all("SELECT pay_date, amount FROM payments WHERE line_id=%s ORDER BY pay_date", (line_id,))
-    df = pd.DataFrame(pays) if pays else pd.DataFrame(columns=["pay_date","amount"])
-    return line, df
+class LineSnapshot:
+    """Line row + bids (list indexed by k, None = chưa có thăm) + optional payment aggregates."""
+    __slots__ = ("line", "bids", "n_bids", "pays")
+
+    def __init__(self, line: dict, bids: list, n_bids: int, pays: Optional[dict] = None):
+        self.line, self.bids, self.n_bids, self.pays = line, bids, n_bids, pays
+
+    def bid_map(self) -> Dict[int, int]:
+        return {k: b for k, b in enumerate(self.bids) if b is not None}
+
+_SNAPSHOT_SQL = """
+SELECT l.*,
+       (SELECT COALESCE(json_agg(json_build_array(r.k, r.bid) ORDER BY r.k), '[]'::json)
+          FROM rounds r WHERE r.line_id = l.id) AS _rounds,
+       CASE WHEN %s THEN
+            (SELECT json_build_object('count', COUNT(*), 'total', COALESCE(SUM(p.amount), 0), 'last', MAX(p.pay_date))
+               FROM payments p WHERE p.line_id = l.id)
+       END AS _pays
+FROM lines l WHERE l.id = ANY(%s)
+"""
+
+def _snapshot_from_row(line: dict) -> LineSnapshot:
+    rounds = line.pop("_rounds") or []
+    pays = line.pop("_pays")
+    size = max([int(line["legs"])] + [int(k) for k, _ in rounds]) + 1
+    bids = [None] * size
+    for k, b in rounds:
+        bids[int(k)] = int(b)
+    return LineSnapshot(line, bids, len(rounds), pays)
+
+def load_line_snapshots(line_ids: List[int], with_payments: bool = False) -> Dict[int, LineSnapshot]:
+    # many lines + their rounds (+ payment aggregates) in a single round trip
+    rows = get_all(_SNAPSHOT_SQL, (with_payments, list(line_ids)))
+    return {int(r["id"]): _snapshot_from_row(r) for r in rows}
+
+def load_line_snapshot(line_id: int, with_payments: bool = False) -> Optional[LineSnapshot]:
+    return load_line_snapshots([line_id], with_payments).get(int(line_id))
+
+# ---------- Line summary (materialized per line, see line_summary table) ----------
+# One precomputed row per line for /tomtat, /hottot and /danhsach. Every write path
+# (/tao, /tham, /hen, /dong, payment imports) locks the line row, writes and calls
+# refresh_line_summaries in one transaction, so two overlapping writes to a line
+# cannot store an older snapshot over a newer one; /lammoi rebuilds all rows and
+# /kiemtra compares them with a live computation. The same pass keeps round_schedule (one row per round of each
+# OPEN line) current for /lich.
+_SUMMARY_COLS = (
+    "line_id", "n_bids", "bids", "k_now", "payout_now", "paid_now", "profit_now", "roi_now",
+    "best_roi_k", "best_roi_payout", "best_roi_paid", "best_roi_profit", "best_roi",
+    "best_profit_k", "best_profit_payout", "best_profit_paid", "best_profit", "best_profit_roi",
+    "next_round_date", "pay_count", "pay_total", "list_row",
+)
+
+def list_row_text(r) -> str:
+    kind = "Tuần" if int(r["period_days"])==7 else "Tháng"
+    return (
+        f"• #{r['id']} · {r['name']} · {kind} · mở {to_user_str(parse_iso(r['start_date']))} · chân {r['legs']} · M {int(r['contrib']):,} VND · "
+        f"sàn {float(r['base_rate']):.2f}% · trần {float(r['cap_rate']):.2f}% · thầu {float(r['thau_rate']):.2f}% · nhắc {int(r['remind_hour']):02d}:{int(r['remind_min']):02d} · {r['status']}"
+    )
+
+def summary_values(snap: LineSnapshot, table=None) -> dict:
+    line, N = snap.line, int(snap.line["legs"])
+    table = table or payout_table(line, snap.bids)
+    k_now = max(1, min(snap.n_bids+1, N))
+    p, r, po, paid = table.row(k_now)
+    rk, (rp, rr, rpo, rpaid) = table.best("roi")
+    lk, (lp, lr, lpo, lpaid) = table.best("lai")
+    pays = snap.pays or {}
+    return {
+        "line_id": int(line["id"]), "n_bids": snap.n_bids, "bids": snap.bids[1:N+1],
+        "k_now": k_now, "payout_now": po, "paid_now": paid, "profit_now": p, "roi_now": r,
+        "best_roi_k": rk, "best_roi_payout": rpo, "best_roi_paid": rpaid, "best_roi_profit": rp, "best_roi": rr,
+        "best_profit_k": lk, "best_profit_payout": lpo, "best_profit_paid": lpaid, "best_profit": lp, "best_profit_roi": lr,
+        "next_round_date": k_date(line, k_now).date(),
+        "pay_count": int(pays.get("count") or 0), "pay_total": int(pays.get("total") or 0),
+        "list_row": list_row_text(line),
+    }
+
+_SCHEDULE_COLS = ("line_id", "k", "chat_id", "due_date", "pay_amount", "payout_amount", "suggested")
+
+def schedule_rows(snap: LineSnapshot, table, best_k: int) -> List[tuple]:
+    # round k: due on k_date, member pays M - bid (M while the bid is unknown),
+    # payout if hốt at k; `suggested` marks the best-ROI round
+    line, M, N = snap.line, int(snap.line["contrib"]), int(snap.line["legs"])
+    start, step = parse_iso(line["start_date"]), int(line["period_days"])
+    bids = snap.bids
+    return [
+        (int(line["id"]), k, line.get("chat_id"), (start + timedelta(days=(k-1)*step)).date(),
+         M - int((bids[k] if k < len(bids) else None) or 0), int(table.payout[k-1]), k == best_k)
+        for k in range(1, N + 1)
+    ]
+
+def lock_lines(line_ids: List[int]):
+    # row locks until the transaction ends; id order so two lockers cannot deadlock
+    exec_sql("SELECT 1 FROM lines WHERE id = ANY(%s) ORDER BY id FOR UPDATE", (list(line_ids),))
+
+def refresh_line_summaries(line_ids: List[int]) -> int:
+    """Recompute and upsert the summary and schedule rows of the given lines (one read + one write each)."""
+    # joins the caller's transaction (after its write) or runs in its own one; either way
+    # the snapshot is read under the line locks
+    with unit_of_work(transaction=True):
+        lock_lines(line_ids)
+        return _refresh_locked(line_ids)
+
+def _refresh_locked(line_ids: List[int]) -> int:
+    import psycopg2.extras
+    from db_pg import connection
+    snaps = load_line_snapshots(line_ids, with_payments=True)
+    if not snaps:
+        return 0
+    values, schedule, closed = [], [], []
+    for lid, sn in snaps.items():
+        if int(sn.line["legs"]) < 1:
+            continue                    # legacy row /tao no longer accepts: no payout table, no summary
+        table = payout_table(sn.line, sn.bids)
+        sv = summary_values(sn, table)
+        values.append(tuple(sv[c] for c in _SUMMARY_COLS))
+        if sn.line["status"] == "OPEN":
+            schedule += schedule_rows(sn, table, sv["best_roi_k"])
+        else:
+            closed.append(lid)
+    updates = ", ".join(f"{c}=EXCLUDED.{c}" for c in _SUMMARY_COLS[1:])
+    sched_cols = ", ".join(_SCHEDULE_COLS[2:])
+    with connection() as conn:
+        cur = conn.cursor()
+        psycopg2.extras.execute_values(
+            cur,
+            f"INSERT INTO line_summary({','.join(_SUMMARY_COLS)}) VALUES %s "
+            f"ON CONFLICT(line_id) DO UPDATE SET {updates}, updated_at=NOW(), version=line_summary.version+1",
+            values, page_size=500
+        )
+        if schedule:
+            # rows whose values did not change are left alone (no dead tuples per /tham)
+            psycopg2.extras.execute_values(
+                cur,
+                f"INSERT INTO round_schedule({','.join(_SCHEDULE_COLS)}) VALUES %s "
+                f"ON CONFLICT(line_id, k) DO UPDATE SET ({sched_cols}) = "
+                f"({', '.join('EXCLUDED.' + c for c in _SCHEDULE_COLS[2:])}) "
+                f"WHERE ({', '.join('round_schedule.' + c for c in _SCHEDULE_COLS[2:])}) IS DISTINCT FROM "
+                f"({', '.join('EXCLUDED.' + c for c in _SCHEDULE_COLS[2:])})",
+                schedule, page_size=1000
+            )
+        if closed:
+            cur.execute("DELETE FROM round_schedule WHERE line_id = ANY(%s)", (closed,))
+        cur.close()
+    # every line write goes through here: drop this instance's cached views
+    line_cache.invalidate(*snaps.keys())
+    return len(values)
+
+def refresh_line_summary(line_id: int) -> int:
+    return refresh_line_summaries([line_id])
+
+def _line_ids_after(after: int, batch: int, chat_id: Optional[int]) -> List[int]:
+    if chat_id is None:
+        rows = get_all("SELECT id FROM lines WHERE id > %s ORDER BY id LIMIT %s", (after, batch))
+    else:
+        rows = get_all("SELECT id FROM lines WHERE chat_id=%s AND id > %s ORDER BY id LIMIT %s", (chat_id, after, batch))
+    return [int(r["id"]) for r in rows]
+
+def rebuild_line_summaries(batch: int = 500, chat_id: Optional[int] = None) -> int:
+    done, after = 0, 0
+    while True:
+        ids = _line_ids_after(after, batch, chat_id)
+        if not ids:
+            return done
+        done += refresh_line_summaries(ids)
+        after = ids[-1]
+
+def check_line_summaries(batch: int = 500, chat_id: Optional[int] = None) -> List[int]:
+    """Line ids whose stored summary differs from a live computation (or is missing)."""
+    bad, after = [], 0
+    while True:
+        ids = _line_ids_after(after, batch, chat_id)
+        if not ids:
+            return bad
+        stored = {int(r["line_id"]): r for r in get_all("SELECT * FROM line_summary WHERE line_id = ANY(%s)", (ids,))}
+        for lid, snap in load_line_snapshots(ids, with_payments=True).items():
+            if int(snap.line["legs"]) < 1:
+                continue
+            row, live = stored.get(lid), summary_values(snap)
+            if row is None or any(row[c] != live[c] for c in _SUMMARY_COLS):
+                bad.append(lid)
+        after = ids[-1]
+
+def _load_line_view(line_id: int):
+    sql = "SELECT l.*, s.* FROM lines l LEFT JOIN line_summary s ON s.line_id = l.id WHERE l.id=%s"
+    rows = get_all(sql, (line_id,))
+    if rows and rows[0]["line_id"] is None:
+        refresh_line_summary(line_id)
+        rows = get_all(sql, (line_id,))
+    return (rows[0], rows[0]["version"]) if rows else (None, None)
+
+def _line_version(line_id: int):
+    rows = get_all("SELECT version FROM line_summary WHERE line_id=%s", (line_id,))
+    return rows[0]["version"] if rows else None
+
+def load_line_view(line_id: int) -> Optional[dict]:
+    """Line row joined with its summary row (cached; builds the summary on first use). Read-only."""
+    line_id = int(line_id)
+    return line_cache.get_or_load(line_id, lambda: _load_line_view(line_id), lambda: _line_version(line_id))
+
+def load_owned_line(line_id: int, chat_id: int) -> Optional[dict]:
+    # lines belong to the chat that created them; other chats see "not found"
+    line = load_line_view(line_id)
+    if line is None or line["chat_id"] is None or int(line["chat_id"]) != int(chat_id):
+        return None
+    return line
 
 # ============= HELP TEXT =============
 def help_text() -> str:
@@ -164,49 +387,183 @@ def help_text() -> str:
         "   ` /tao Hui10tr tuần 10-10-2025 12 10tr 8 20 50 `\n\n"
         "2) Nhập thăm kỳ:\n"
         "   /tham <mã_dây> <kỳ> <số_tiền_thăm> [DD-MM-YYYY]\n"
-        "   Ví dụ: ` /tham 1 1 2tr 10-10-2025 `\n\n"
+        "   Ví dụ: ` /tham 1 1 2tr 10-10-2025 `\n"
+        "   Nhiều kỳ: /tham <mã_dây> rồi mỗi dòng ` <kỳ> <số_tiền_thăm> [DD-MM-YYYY] `\n"
+        "   Từ file: gửi CSV (loai,ky,tien,ngay) kèm chú thích /nhap <mã_dây>\n\n"
         "3) Đặt giờ nhắc riêng:\n"
         "   /hen <mã_dây> <HH:MM>\n\n"
         "4) Danh sách / Tóm tắt / Gợi ý hốt:\n"
-        "   /danhsach\n"
+        "   /danhsach [mo|dong]\n"
         "   /tomtat <mã_dây>\n"
         "   /hottot <mã_dây> [Roi%|Lãi]\n\n"
         "5) Đóng dây: /dong <mã_dây>\n\n"
         "6) Cài nơi nhận báo cáo & nhắc (gửi vào chat hiện tại nếu không nhập):\n"
         "   /baocao [chat_id]\n\n"
+        "7) Bảo trì tóm tắt: /kiemtra (so với dữ liệu gốc) · /lammoi (tính lại tất cả)\n\n"
+        "8) Xuất báo cáo tháng (CSV/Excel): /xuat [MM-YYYY] [csv|xlsx]\n\n"
+        "9) Lịch dòng tiền (phải đóng / hốt theo gợi ý): /lich [từ DD-MM-YYYY] [đến DD-MM-YYYY]\n\n"
         "📜 Gõ /lenh bất cứ lúc nào để hiện lại danh sách lệnh."
     )
 
-# ---------- Minimal UI helpers ----------
-def list_text() -> str:
-    rows = get_all("SELECT id,name,period_days,start_date,legs,contrib,base_rate,cap_rate,thau_rate,status,remind_hour,remind_min FROM lines ORDER BY id DESC")
-    if not rows: return "📂 Chưa có dây nào."
-    out = ["📋 **Danh sách dây**:"]
+# ---------- Cash-flow calendar (/lich) ----------
+CALENDAR_DAYS = 30   # /lich không tham số: 30 ngày từ hôm nay
+
+_CALENDAR_SQL = """
+SELECT due_date, COUNT(*) AS rounds, SUM(pay_amount) AS pay,
+       COUNT(*) FILTER (WHERE suggested) AS hot_rounds,
+       COALESCE(SUM(payout_amount) FILTER (WHERE suggested), 0) AS hot
+FROM round_schedule
+WHERE chat_id=%s AND due_date BETWEEN %s AND %s
+GROUP BY due_date
+ORDER BY due_date
+"""
+
+# OPEN lines with no schedule yet (written before round_schedule existed): built on the
+# first /lich of their chat, like line_summary rows, instead of one big backfill in a
+# migration. Every later write keeps the rows, so a chat is done once; that is recorded in
+# configs (and remembered per instance), and from then on /lich is one range scan.
+_UNSCHEDULED_SQL = """
+SELECT l.id FROM lines l
+WHERE l.chat_id=%s AND l.status='OPEN' AND l.legs >= 1
+  AND NOT EXISTS (SELECT 1 FROM round_schedule r WHERE r.line_id = l.id)
+ORDER BY l.id
+"""
+_scheduled_chats: set = set()
+
+def _ensure_schedule(chat_id: int):
+    if chat_id in _scheduled_chats:
+        return
+    key = f"schedule_built:{chat_id}"
+    if not cfg_get(key):
+        missing = [int(r["id"]) for r in get_all(_UNSCHEDULED_SQL, (chat_id,))]
+        for i in range(0, len(missing), 500):
+            refresh_line_summaries(missing[i:i + 500])
+        cfg_set(key, True)
+    _scheduled_chats.add(chat_id)
+
+def calendar_rows(chat_id: int, d0: str, d1: str) -> List[dict]:
+    _ensure_schedule(chat_id)
+    return get_all(_CALENDAR_SQL, (chat_id, d0, d1))
+
+def calendar_text(d0: datetime, d1: datetime, rows: List[dict]) -> str:
+    head = f"📅 Lịch dòng tiền {to_user_str(d0)} → {to_user_str(d1)}"
+    if not rows:
+        return head + "\n📂 Không có kỳ nào trong khoảng này."
+    pay = sum(int(r["pay"]) for r in rows)
+    hot = sum(int(r["hot"]) for r in rows)
+    out = [
+        head,
+        f"• Phải đóng: {sum(int(r['rounds']) for r in rows)} kỳ · {pay:,} VND",
+        f"• Hốt theo gợi ý (ROI): {sum(int(r['hot_rounds']) for r in rows)} kỳ · {hot:,} VND",
+        f"• Ròng: {hot - pay:+,} VND",
+        "Theo ngày:",
+    ]
     for r in rows:
-        kind = "Tuần" if int(r["period_days"])==7 else "Tháng"
-        out.append(
-            f"• #{r['id']} · {r['name']} · {kind} · mở {to_user_str(parse_iso(r['start_date']))} · chân {r['legs']} · M {int(r['contrib']):,} VND · "
-            f"sàn {float(r['base_rate']):.2f}% · trần {float(r['cap_rate']):.2f}% · thầu {float(r['thau_rate']):.2f}% · nhắc {int(r['remind_hour']):02d}:{int(r['remind_min']):02d} · {r['status']}"
-        )
+        line = f"• {to_user_str(parse_iso(r['due_date']))} · đóng {int(r['pay']):,} ({r['rounds']} kỳ)"
+        if r["hot_rounds"]:
+            line += f" · hốt {int(r['hot']):,}"
+        out.append(line)
     return "\n".join(out)
 
+# ---------- Minimal UI helpers ----------
+_LIST_FILTERS = {"all": None, "mo": "OPEN", "dong": "CLOSED"}
+
+def _fill_list_rows(rows: List[dict]) -> List[dict]:
+    # lines without a summary row yet get one now
+    missing = [int(r["id"]) for r in rows if r["list_row"] is None]
+    if not missing:
+        return rows
+    refresh_line_summaries(missing)
+    fixed = {int(r["line_id"]): r["list_row"] for r in get_all("SELECT line_id, list_row FROM line_summary WHERE line_id = ANY(%s)", (missing,))}
+    return [{"id": r["id"], "list_row": r["list_row"] or fixed.get(int(r["id"])) or f"• #{r['id']} · ⚠️ số chân không hợp lệ"}
+            for r in rows]
+
+def list_page(chat_id: int, status: Optional[str] = None, before_id: Optional[int] = None,
+              limit: int = LIST_PAGE_SIZE) -> Tuple[List[dict], bool]:
+    """Keyset page of the chat's lines, newest first: (rows, has_more)."""
+    # lines_chat_idx / lines_chat_status_idx: cost depends on the page, not on total lines
+    sql = ("SELECT l.id, s.list_row FROM lines l LEFT JOIN line_summary s ON s.line_id = l.id "
+           "WHERE l.chat_id=%s")
+    params: List[Any] = [chat_id]
+    if status:
+        sql += " AND l.status=%s"; params.append(status)
+    if before_id:
+        sql += " AND l.id < %s"; params.append(before_id)
+    sql += " ORDER BY l.id DESC LIMIT %s"; params.append(limit + 1)
+    rows = _fill_list_rows(get_all(sql, tuple(params)))
+    return rows[:limit], len(rows) > limit
+
+def list_view(chat_id: int, code: str = "all", before_id: Optional[int] = None):
+    """(text, reply_markup) for one /danhsach page; the text always fits one message."""
+    rows, more = list_page(chat_id, _LIST_FILTERS.get(code), before_id)
+    title = {"all": "", "mo": " (đang mở)", "dong": " (đã đóng)"}.get(code, "")
+    out = [f"📋 **Danh sách dây**{title}" + (" — trang sau" if before_id else "") + ":"]
+    shown = []
+    for r in rows:
+        if sum(len(x) + 1 for x in out) + len(r["list_row"]) > TG_TEXT_LIMIT:
+            more = True
+            break
+        out.append(r["list_row"]); shown.append(r)
+    if not shown:
+        out = ["📂 Chưa có dây nào." if not before_id else "📂 Không còn dây nào."]
+    filters_row = [(("• " if c == code else "") + label, f"ds:{c}:0")
+                   for c, label in (("all", "Tất cả"), ("mo", "Đang mở"), ("dong", "Đã đóng"))]
+    nav = []
+    if before_id:
+        nav.append(("⏮ Đầu", f"ds:{code}:0"))
+    if more and shown:
+        nav.append(("Sau ▶", f"ds:{code}:{shown[-1]['id']}"))
+    return "\n".join(out), inline_kb([filters_row] + ([nav] if nav else []))
+
 # ---------- Commands using Postgres ----------
+# Handlers await DB work through run_db (thread pool), so with concurrent updates one
+# slow query does not hold up other chats. In polling mode _uow runs each chat's updates
+# one at a time, in arrival order; a line is only written by its owner chat, so writes
+# to the same line apply in order too.
 def _int_like(s: str) -> int:
     m = re.search(r"-?\d+", s or "")
     if not m: raise ValueError(f"Không phải số: {s}")
     return int(m.group(0))
 
+_chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def chat_lock(chat_id: int) -> asyncio.Lock:
+    # dropped automatically once no update holds or waits for it
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+def _update_line(line_id: int, chat_id: int, sets: str, params: tuple):
+    with unit_of_work(transaction=True):
+        lock_lines([line_id])
+        exec_sql(f"UPDATE lines SET {sets} WHERE id=%s AND chat_id=%s", params + (line_id, chat_id))
+        refresh_line_summary(line_id)
+
 async def cmd_setreport(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    cfg = load_cfg()
+    cfg = await run_db(load_cfg)
     if ctx.args:
         try: cid = int(ctx.args[0])
         except Exception: return await upd.message.reply_text("❌ `chat_id` không hợp lệ.")
     else:
         cid = upd.effective_chat.id
     cfg["report_chat_id"] = cid
-    save_cfg(cfg)
+    await run_db(save_cfg, cfg)
     await upd.message.reply_text(f"✅ Đã lưu nơi nhận báo cáo/nhắc: {cid}")
 
+def create_line(chat_id, name, period_days, start_iso, legs, contrib, base_rate, cap_rate, thau_rate) -> int:
+    # the line and its summary commit together: no line without a summary row
+    with unit_of_work(transaction=True):
+        line_id = insert_and_get_id(
+            """
+            INSERT INTO lines(chat_id,name,period_days,start_date,legs,contrib,bid_type,bid_value,status,base_rate,cap_rate,thau_rate,remind_hour,remind_min,last_remind_iso)
+            VALUES(%s,%s,%s,%s,%s,%s,'dynamic',0,'OPEN',%s,%s,%s,8,0,NULL)
+            """,
+            (chat_id, name, period_days, start_iso, legs, contrib, base_rate, cap_rate, thau_rate)
+        )
+        refresh_line_summary(line_id)
+    return line_id
+
 async def _create_line_and_reply(upd: Update, name, kind, start_user, legs, contrib, base_rate, cap_rate, thau_rate):
     kind_l = str(kind).lower()
     period_days = 7 if kind_l in ["tuan","tuần","t","week","weekly"] else 30
@@ -215,16 +572,13 @@ async def _create_line_and_reply(upd: Update, name, kind, start_user, legs, cont
     legs      = int(legs)
     contrib_i = parse_money(contrib)
     base_rate = float(base_rate); cap_rate = float(cap_rate); thau_rate = float(thau_rate)
+    if legs < 1: raise ValueError("số chân phải >= 1")
+    if contrib_i <= 0: raise ValueError("mệnh giá phải > 0")
     if not (0 <= base_rate <= cap_rate <= 100): raise ValueError("sàn% <= trần% và nằm trong [0..100]")
     if not (0 <= thau_rate <= 100): raise ValueError("đầu thảo% trong [0..100]")
 
-    line_id = insert_and_get_id(
-        """
-        INSERT INTO lines(name,period_days,start_date,legs,contrib,bid_type,bid_value,status,base_rate,cap_rate,thau_rate,remind_hour,remind_min,last_remind_iso)
-        VALUES(%s,%s,%s,%s,%s,'dynamic',0,'OPEN',%s,%s,%s,8,0,NULL)
-        """,
-        (name, period_days, start_iso, legs, contrib_i, base_rate, cap_rate, thau_rate)
-    )
+    line_id = await run_db(create_line, upd.effective_chat.id, name, period_days, start_iso, legs, contrib_i,
+                           base_rate, cap_rate, thau_rate)
 
     await upd.message.reply_text(
         f"✅ Tạo dây #{line_id} ({name}) — {'Hụi Tuần' if period_days==7 else 'Hụi Tháng'}\n"
@@ -234,31 +588,233 @@ async def _create_line_and_reply(upd: Update, name, kind, start_user, legs, cont
         f"➡️ Nhập thăm: /tham {line_id} <kỳ> <số_tiền_thăm> [DD-MM-YYYY]"
     )
 
+async def cmd_create(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if len(ctx.args) < 8:
+        return await upd.message.reply_text(
+            "❌ Cú pháp: /tao <tên> <tuần|tháng> <DD-MM-YYYY> <số_chân> <mệnh_giá> <giá_sàn_%> <giá_trần_%> <đầu_thảo_%>"
+        )
+    try:
+        await _create_line_and_reply(upd, *ctx.args[:8])
+    except ValueError as e:
+        await upd.message.reply_text(f"❌ Tham số không hợp lệ: {e}")
+
+def save_round(line_id: int, k: int, bid: int, rdate_iso: Optional[str]):
+    with unit_of_work(transaction=True):
+        lock_lines([line_id])
+        exec_sql(
+            """
+            INSERT INTO rounds(line_id,k,bid,round_date) VALUES(%s,%s,%s,%s)
+            ON CONFLICT(line_id,k) DO UPDATE SET bid=EXCLUDED.bid, round_date=EXCLUDED.round_date
+            """,
+            (line_id, k, bid, rdate_iso)
+        )
+        refresh_line_summary(line_id)
+
 async def _save_tham_msg(upd: Update, line_id: int, k: int, bid: int, rdate_iso: Optional[str]):
-    rows = get_all("SELECT * FROM lines WHERE id=%s", (line_id,))
-    if not rows:  return await upd.message.reply_text("❌ Không tìm thấy dây.")
-    line = rows[0]
+    line = await run_db(load_owned_line, line_id, upd.effective_chat.id)
+    if not line:  return await upd.message.reply_text("❌ Không tìm thấy dây.")
     if not (1 <= k <= int(line["legs"])): return await upd.message.reply_text(f"❌ Kỳ hợp lệ 1..{line['legs']}.")
-    M = int(line["contrib"])
-    min_bid = int(round(M * float(line.get("base_rate", 0)) / 100.0))
-    max_bid = int(round(M * float(line.get("cap_rate", 100)) / 100.0))
+    min_bid, max_bid = bid_range(line)
     if bid < min_bid or bid > max_bid:
         return await upd.message.reply_text(
             f"❌ Thăm phải trong [{min_bid:,} .. {max_bid:,}] VND "
-            f"(Sàn {line['base_rate']}% · Trần {line['cap_rate']}% · M={M:,})"
+            f"(Sàn {line['base_rate']}% · Trần {line['cap_rate']}% · M={int(line['contrib']):,})"
         )
 
-    exec_sql(
-        """
-        INSERT INTO rounds(line_id,k,bid,round_date) VALUES(%s,%s,%s,%s)
-        ON CONFLICT(line_id,k) DO UPDATE SET bid=EXCLUDED.bid, round_date=EXCLUDED.round_date
-        """,
-        (line_id, k, bid, rdate_iso)
-    )
+    await run_db(save_round, line_id, k, bid, rdate_iso)
     await upd.message.reply_text(
         f"✅ Lưu thăm kỳ {k} cho dây #{line_id}: {bid:,} VND" + (f" · ngày {to_user_str(parse_iso(rdate_iso))}" if rdate_iso else "")
     )
 
+async def cmd_tham(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    rows = [ln.strip() for ln in (upd.message.text or "").splitlines() if ln.strip()]
+    if len(rows) > 1:
+        return await _tham_batch(upd, rows)
+    if len(ctx.args) < 3:
+        return await upd.message.reply_text("❌ Cú pháp: /tham <mã_dây> <kỳ> <số_tiền_thăm> [DD-MM-YYYY]")
+    try:
+        line_id, k = int(ctx.args[0]), int(ctx.args[1])
+        bid = parse_money(ctx.args[2])
+        rdate_iso = to_iso_str(parse_user_date(ctx.args[3])) if len(ctx.args) >= 4 else None
+    except ValueError as e:
+        return await upd.message.reply_text(f"❌ Tham số không hợp lệ: {e}")
+    await _save_tham_msg(upd, line_id, k, bid, rdate_iso)
+
+# ----- Bulk import: /tham nhiều dòng, /nhap <mã_dây> + file CSV -----
+# Everything is validated in memory first; a batch with any bad row writes nothing. Nor does
+# one with a payment the line already has (same day and amount), so a re-sent file is not
+# counted twice.
+def bid_range(line) -> Tuple[int, int]:
+    M = int(line["contrib"])
+    return (int(round(M * float(line.get("base_rate", 0)) / 100.0)),
+            int(round(M * float(line.get("cap_rate", 100)) / 100.0)))
+
+def _norm_word(s: str) -> str:
+    return strip_accents((s or "").strip().lower()).replace("đ", "d").replace(" ", "_")
+
+def validate_import(line, rows: List[Tuple[int, str, str, str, str]]):
+    """rows: (dòng, loại, kỳ, tiền, ngày) as text -> (rounds {k: (bid, date_iso)}, payments [(date_iso, amount)], errors)."""
+    legs = int(line["legs"])
+    lo, hi = bid_range(line)
+    rounds: Dict[int, Tuple[int, Optional[str]]] = {}
+    pays: List[Tuple[str, int]] = []
+    errors: List[Tuple[int, str]] = []
+    for no, kind, k, amount, day in rows:
+        try:
+            kind = _norm_word(kind) or "tham"
+            if not (amount or "").strip(): raise ValueError("thiếu số tiền")
+            money = parse_money(amount)
+            day_iso = to_iso_str(parse_any_date(day)) if (day or "").strip() else None
+            if kind in ("tham", "t"):
+                try: kk = int(str(k).strip())
+                except ValueError: raise ValueError(f"kỳ không hợp lệ: {k}")
+                if not 1 <= kk <= legs: raise ValueError(f"kỳ hợp lệ 1..{legs}")
+                if not lo <= money <= hi: raise ValueError(f"thăm {money:,} ngoài [{lo:,} .. {hi:,}]")
+                rounds[kk] = (money, day_iso)            # a later row for the same kỳ wins
+            elif kind in ("dong", "d"):
+                if day_iso is None: raise ValueError("khoản đóng cần ngày")
+                if money <= 0: raise ValueError("số tiền phải > 0")
+                pays.append((day_iso, money))
+            else:
+                raise ValueError(f"loại phải là tham|dong, không phải '{kind}'")
+        except ValueError as e:
+            errors.append((no, str(e)))
+    return rounds, pays, errors
+
+_CSV_COLUMNS = {
+    "loai": "kind", "type": "kind",
+    "ky": "k", "k": "k",
+    "tien": "amount", "so_tien": "amount", "tham": "amount", "amount": "amount",
+    "ngay": "day", "date": "day",
+}
+
+def _is_header(row: List[str]) -> bool:
+    # names only (a data row always has a number in it), at least one of them a known column
+    return (not any(ch.isdigit() for c in row for ch in c)
+            and any(_norm_word(c) in _CSV_COLUMNS for c in row))
+
+def parse_import_csv(text: str) -> List[Tuple[int, str, str, str, str]]:
+    """CSV (',' ';' or tab) with header loai,ky,tien,ngay in any order (any name in
+    _CSV_COLUMNS); without a header the columns are taken in that order."""
+    try:
+        dialect = csv.Sniffer().sniff(text[:2048], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows = list(csv.reader(io.StringIO(text), dialect))
+    order = ["kind", "k", "amount", "day"]
+    start = 0
+    if rows and _is_header(rows[0]):
+        order = [_CSV_COLUMNS.get(_norm_word(c), "") for c in rows[0]]
+        start = 1
+    out = []
+    for no, row in enumerate(rows[start:], start=start + 1):
+        if not any(c.strip() for c in row):
+            continue
+        rec = {name: val for name, val in zip(order, row) if name}
+        out.append((no, rec.get("kind", ""), rec.get("k", ""), rec.get("amount", ""), rec.get("day", "")))
+    return out
+
+def _recorded_payments(line_id: int, pays: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    # payments of the batch the line already has (same day and amount): a re-sent file
+    if not pays:
+        return []
+    rows = get_all("SELECT DISTINCT to_char(pay_date, 'YYYY-MM-DD') AS d, amount FROM payments "
+                   "WHERE line_id=%s AND pay_date = ANY(%s::date[])",
+                   (line_id, sorted({d for d, _ in pays})))
+    have = {(r["d"], int(r["amount"])) for r in rows}
+    return sorted({p for p in pays if p in have})
+
+def write_import(line_id: int, rounds: Dict[int, Tuple[int, Optional[str]]], pays: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    """Write the batch, or nothing and return the payments already recorded for the line."""
+    import psycopg2.extras
+    with unit_of_work(transaction=True) as conn:
+        lock_lines([line_id])
+        dup = _recorded_payments(line_id, pays)
+        if dup:
+            return dup
+        cur = conn.cursor()
+        if rounds:
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO rounds(line_id,k,bid,round_date) VALUES %s "
+                "ON CONFLICT(line_id,k) DO UPDATE SET bid=EXCLUDED.bid, round_date=EXCLUDED.round_date",
+                [(line_id, k, bid, day) for k, (bid, day) in sorted(rounds.items())],
+                template="(%s,%s,%s,%s::date)", page_size=1000
+            )
+        if pays:
+            psycopg2.extras.execute_values(
+                cur, "INSERT INTO payments(line_id,pay_date,amount) VALUES %s",
+                [(line_id, day, amount) for day, amount in pays], page_size=1000
+            )
+        cur.close()
+        refresh_line_summary(line_id)
+    return []
+
+async def _import_and_reply(upd: Update, line, rows):
+    line_id = int(line["id"])
+    if len(rows) > IMPORT_MAX_ROWS:
+        return await upd.message.reply_text(f"❌ Tối đa {IMPORT_MAX_ROWS} dòng mỗi lần nhập.")
+    rounds, pays, errors = validate_import(line, rows)
+    if errors:
+        out = [f"❌ Chưa nhập gì — {len(errors)}/{len(rows)} dòng lỗi (sửa rồi gửi lại):"]
+        out += [f"• dòng {no}: {err}" for no, err in errors[:IMPORT_MAX_ERRORS]]
+        if len(errors) > IMPORT_MAX_ERRORS:
+            out.append(f"… và {len(errors) - IMPORT_MAX_ERRORS} dòng lỗi khác")
+        return await reply_long(upd, "\n".join(out))
+    if not rounds and not pays:
+        return await upd.message.reply_text("❌ Không có dòng dữ liệu nào.")
+    dup = await run_db(write_import, line_id, rounds, pays)
+    if dup:
+        out = [f"❌ Chưa nhập gì — {len(dup)} khoản đóng đã có (cùng ngày, cùng số tiền); file đã nhập rồi?"]
+        out += [f"• {to_user_str(parse_iso(d))} · {a:,} VND" for d, a in dup[:IMPORT_MAX_ERRORS]]
+        if len(dup) > IMPORT_MAX_ERRORS:
+            out.append(f"… và {len(dup) - IMPORT_MAX_ERRORS} khoản khác")
+        return await reply_long(upd, "\n".join(out))
+    msg = [f"✅ Đã nhập dây #{line_id}:"]
+    if rounds: msg.append(f"• {len(rounds)} thăm (kỳ {min(rounds)}..{max(rounds)})")
+    if pays:   msg.append(f"• {len(pays)} khoản đóng · tổng {sum(a for _, a in pays):,} VND")
+    await upd.message.reply_text("\n".join(msg))
+
+async def _tham_batch(upd: Update, rows: List[str]):
+    # /tham <mã_dây>            (dòng 1, có thể kèm luôn 1 thăm)
+    # <kỳ> <số_tiền_thăm> [DD-MM-YYYY]   (mỗi dòng 1 kỳ)
+    head = rows[0].split()[1:]
+    try:
+        line_id = _int_like(head[0]) if head else None
+    except ValueError:
+        line_id = None
+    if line_id is None:
+        return await upd.message.reply_text("❌ Cú pháp: /tham <mã_dây>, rồi mỗi dòng: <kỳ> <số_tiền_thăm> [DD-MM-YYYY]")
+    body = ([(1, head[1:])] if len(head) > 1 else []) + [(no, ln.split()) for no, ln in enumerate(rows[1:], start=2)]
+    parsed = [(no, "tham", p[0], p[1] if len(p) > 1 else "", p[2] if len(p) > 2 else "") for no, p in body]
+    line = await run_db(load_owned_line, line_id, upd.effective_chat.id)
+    if not line: return await upd.message.reply_text("❌ Không tìm thấy dây.")
+    await _import_and_reply(upd, line, parsed)
+
+async def cmd_import(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    usage = ("❌ Gửi file CSV kèm chú thích: /nhap <mã_dây>\n"
+             "Cột: loai,ky,tien,ngay — loai: tham (kỳ + tiền thăm) | dong (tiền đóng + ngày)")
+    msg = upd.message
+    args = (getattr(msg, "caption", None) or msg.text or "").split()[1:]
+    doc = getattr(msg, "document", None)
+    if not args or doc is None:
+        return await msg.reply_text(usage)
+    try:
+        line_id = _int_like(args[0])
+    except ValueError:
+        return await msg.reply_text(usage)
+    if (doc.file_size or 0) > IMPORT_MAX_BYTES:
+        return await msg.reply_text(f"❌ File quá lớn (tối đa {IMPORT_MAX_BYTES // 1024} KB).")
+    line = await run_db(load_owned_line, line_id, upd.effective_chat.id)
+    if not line: return await msg.reply_text("❌ Không tìm thấy dây.")
+    f = await ctx.bot.get_file(doc.file_id)
+    raw = bytes(await f.download_as_bytearray())
+    try:
+        text = raw.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return await msg.reply_text("❌ File phải là CSV mã hoá UTF-8.")
+    await _import_and_reply(upd, line, parse_import_csv(text))
+
 async def cmd_set_remind(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if len(ctx.args) != 2:
         return await upd.message.reply_text("❌ Cú pháp: /hen <mã_dây> <HH:MM>  (VD: /hen 1 07:45)")
@@ -268,36 +824,56 @@ async def cmd_set_remind(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if not (0 <= hh <= 23 and 0 <= mm <= 59): raise ValueError("giờ/phút không hợp lệ")
     except Exception as e:
         return await upd.message.reply_text(f"❌ Tham số không hợp lệ: {e}")
-    rows = get_all("SELECT id FROM lines WHERE id=%s", (line_id,))
-    if not rows: return await upd.message.reply_text("❌ Không tìm thấy dây.")
-    exec_sql("UPDATE lines SET remind_hour=%s, remind_min=%s WHERE id=%s", (hh, mm, line_id))
+    if not await run_db(load_owned_line, line_id, upd.effective_chat.id):
+        return await upd.message.reply_text("❌ Không tìm thấy dây.")
+    await run_db(_update_line, line_id, upd.effective_chat.id, "remind_hour=%s, remind_min=%s", (hh, mm))
     await upd.message.reply_text(f"✅ Đã đặt giờ nhắc cho dây #{line_id}: {hh:02d}:{mm:02d}")
 
 # ----- List / Summary / Suggest / Close -----
 async def cmd_list(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    await upd.message.reply_text(list_text())
+    code = "all"
+    if ctx.args:
+        code = {"mo": "mo", "open": "mo", "dong": "dong", "closed": "dong"}.get(_norm_word(ctx.args[0]))
+        if code is None:
+            return await upd.message.reply_text("❌ Cú pháp: /danhsach [mo|dong]")
+    text, markup = await run_db(list_view, upd.effective_chat.id, code)
+    await upd.message.reply_text(text, reply_markup=markup)
+
+async def cb_list_page(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # inline-keyboard paging: edit the list message in place
+    q = upd.callback_query
+    try:
+        _, code, before = q.data.split(":")
+        before_id = int(before) or None
+    except ValueError:
+        return await q.answer("❌ Dữ liệu không hợp lệ.")
+    text, markup = await run_db(list_view, upd.effective_chat.id, code if code in _LIST_FILTERS else "all", before_id)
+    await q.answer()
+    try:
+        await q.edit_message_text(text, reply_markup=markup)
+    except Exception as e:
+        if "not modified" not in str(e).lower():
+            raise
 
 async def cmd_summary(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try: line_id = _int_like(ctx.args[0])
     except Exception: return await upd.message.reply_text("❌ Cú pháp: /tomtat <mã_dây>")
-    line, _ = load_line_full(line_id)
+    line = await run_db(load_owned_line, line_id, upd.effective_chat.id)
     if not line: return await upd.message.reply_text("❌ Không tìm thấy dây.")
-    bids = get_bids(line_id)
     M, N = int(line["contrib"]), int(line["legs"])
     cfg_line = f"Sàn {float(line.get('base_rate',0)):.2f}% · Trần {float(line.get('cap_rate',100)):.2f}% · Đầu thảo {float(line.get('thau_rate',0)):.2f}% (trên M)"
-    k_now = max(1, min(len(bids)+1, N))
-    p, r, po, paid = compute_profit_var(line, k_now, bids)
-    bestk, (bp, br, bpo, bpaid) = best_k_var(line, bids, metric="roi")
+    bids = [(kk, b) for kk, b in enumerate(line["bids"] or [], start=1) if b is not None]
+    bestk = line["best_roi_k"]
     msg = [
         f"📌 Dây #{line['id']} · {line['name']} · {'Tuần' if int(line['period_days'])==7 else 'Tháng'}",
         f"• Mở: {to_user_str(parse_iso(line['start_date']))} · Chân: {N} · Mệnh giá/kỳ: {M:,} VND",
         f"• {cfg_line} · Nhắc {int(line.get('remind_hour',8)):02d}:{int(line.get('remind_min',0)):02d}",
-        f"• Thăm: " + (", ".join([f"k{kk}:{int(b):,}" for kk,b in sorted(bids.items())]) if bids else "(chưa có)"),
-        f"• Kỳ hiện tại ước tính: {k_now} · Payout: {po:,} · Đã đóng: {paid:,} → Lãi: {int(round(p)):,} (ROI {roi_to_str(r)})",
-        f"⭐ Đề xuất (ROI): kỳ {bestk} · ngày {to_user_str(k_date(line,bestk))} · Payout {bpo:,} · Đã đóng {bpaid:,} · Lãi {int(round(bp)):,} · ROI {roi_to_str(br)}"
+        f"• Thăm: " + (", ".join([f"k{kk}:{int(b):,}" for kk,b in bids]) if bids else "(chưa có)"),
+        f"• Kỳ hiện tại ước tính: {line['k_now']} · Payout: {line['payout_now']:,} · Đã đóng: {line['paid_now']:,} → Lãi: {int(line['profit_now']):,} (ROI {roi_to_str(line['roi_now'])})",
+        f"⭐ Đề xuất (ROI): kỳ {bestk} · ngày {to_user_str(k_date(line,bestk))} · Payout {line['best_roi_payout']:,} · Đã đóng {line['best_roi_paid']:,} · Lãi {int(line['best_roi_profit']):,} · ROI {roi_to_str(line['best_roi'])}"
     ]
     if is_finished(line): msg.append("✅ Dây đã đến hạn — /dong để lưu trữ.")
-    await upd.message.reply_text("\n".join(msg))
+    await reply_long(upd, "\n".join(msg))
 
 async def cmd_whenhot(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if len(ctx.args) < 1: return await upd.message.reply_text("❌ Cú pháp: /hottot <mã_dây> [Roi%|Lãi]")
@@ -307,10 +883,12 @@ async def cmd_whenhot(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if len(ctx.args) >= 2:
         raw = strip_accents(ctx.args[1].strip().lower().replace("%", ""))
         if raw in ("roi", "lai"): metric = raw
-    line, _ = load_line_full(line_id)
+    line = await run_db(load_owned_line, line_id, upd.effective_chat.id)
     if not line: return await upd.message.reply_text("❌ Không tìm thấy dây.")
-    bids = get_bids(line_id)
-    bestk, (bp, br, bpo, bpaid) = best_k_var(line, bids, metric=("roi" if metric=="roi" else "lai"))
+    if metric == "roi":
+        bestk, bp, br, bpo, bpaid = (line[c] for c in ("best_roi_k", "best_roi_profit", "best_roi", "best_roi_payout", "best_roi_paid"))
+    else:
+        bestk, bp, br, bpo, bpaid = (line[c] for c in ("best_profit_k", "best_profit", "best_profit_roi", "best_profit_payout", "best_profit_paid"))
     await upd.message.reply_text(
         f"🔎 Gợi ý theo {'ROI%' if metric=='roi' else 'Lãi'}:\n"
         f"• Nên hốt kỳ: {bestk}\n"
@@ -323,9 +901,58 @@ async def cmd_whenhot(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_close(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try: line_id = _int_like(ctx.args[0])
     except Exception: return await upd.message.reply_text("❌ Cú pháp: /dong <mã_dây>")
-    exec_sql("UPDATE lines SET status='CLOSED' WHERE id=%s", (line_id,))
+    if not await run_db(load_owned_line, line_id, upd.effective_chat.id):
+        return await upd.message.reply_text("❌ Không tìm thấy dây.")
+    await run_db(_update_line, line_id, upd.effective_chat.id, "status='CLOSED'", ())
     await upd.message.reply_text(f"🗂️ Đã đóng & lưu trữ dây #{line_id}.")
 
+async def cmd_calendar(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # /lich [từ] [đến] — mặc định 30 ngày tới
+    try:
+        now = now_local()
+        d0 = parse_any_date(ctx.args[0]) if ctx.args else datetime(now.year, now.month, now.day)
+        d1 = parse_any_date(ctx.args[1]) if len(ctx.args) > 1 else d0 + timedelta(days=CALENDAR_DAYS - 1)
+    except ValueError as e:
+        return await upd.message.reply_text(f"❌ {e} (VD: /lich 01-10-2025 31-10-2025)")
+    if d1 < d0:
+        return await upd.message.reply_text("❌ Ngày kết thúc phải sau ngày bắt đầu.")
+    rows = await run_db(calendar_rows, upd.effective_chat.id, to_iso_str(d0), to_iso_str(d1))
+    await reply_long(upd, calendar_text(d0, d1, rows))
+
+async def cmd_export(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # /xuat [MM-YYYY] [csv|xlsx] — báo cáo tháng (mặc định tháng này) cho các dây của chat
+    from reports import parse_month, chat_totals, report_caption, build_export
+    args = [a.lower() for a in ctx.args]
+    fmt = "xlsx" if "xlsx" in args else "csv"
+    rest = [a for a in args if a not in ("csv", "xlsx")]
+    try:
+        month = parse_month(rest[0]) if rest else now_local().strftime("%Y-%m")
+    except ValueError as e:
+        return await upd.message.reply_text(f"❌ {e} (VD: /xuat 09-2025 xlsx)")
+    cid = upd.effective_chat.id
+    totals = await run_db(chat_totals, month, chat_id=cid)
+    if not totals:
+        return await upd.message.reply_text("📂 Chưa có dây nào.")
+    f, filename = await run_db(build_export, month, cid, fmt)
+    try:
+        caption = report_caption(month, totals[0])
+        if fmt == "xlsx" and not filename.endswith(".xlsx"):
+            caption = (caption + "\n(Máy chủ chưa cài openpyxl — gửi CSV)")[:1024]
+        await upd.message.reply_document(document=f, filename=filename, caption=caption)
+    finally:
+        f.close()
+
+async def cmd_rebuild_summary(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    n = await run_db(rebuild_line_summaries, chat_id=upd.effective_chat.id)
+    await upd.message.reply_text(f"♻️ Đã tính lại tóm tắt cho {n} dây.")
+
+async def cmd_check_summary(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    bad = await run_db(check_line_summaries, chat_id=upd.effective_chat.id)
+    if not bad:
+        return await upd.message.reply_text("✅ Tóm tắt khớp với dữ liệu gốc.")
+    shown = ", ".join(f"#{i}" for i in bad[:30]) + (" …" if len(bad) > 30 else "")
+    await upd.message.reply_text(f"⚠️ {len(bad)} dây lệch tóm tắt: {shown}\n➡️ /lammoi để tính lại.")
+
 # ---------- /huy & wizard placeholders ----------
 async def cmd_cancel(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await upd.message.reply_text("🛑 Huỷ wizard (serverless không dùng wizard nhiều bước).")
@@ -333,22 +960,76 @@ async def cmd_cancel(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def handle_text(upd: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await upd.message.reply_text("💡 Vui lòng dùng các lệnh: /tao, /tham, /hen, /danhsach, /tomtat, /hottot, /dong")
 
+# ---------- Command table (shared by polling main() and the webhook dispatcher) ----------
+COMMANDS = {
+    "start":    cmd_list,
+    "lenh":     cmd_list,
+    "baocao":   cmd_setreport,
+    "tao":      cmd_create,
+    "tham":     cmd_tham,
+    "nhap":     cmd_import,
+    "hen":      cmd_set_remind,
+    "danhsach": cmd_list,
+    "tomtat":   cmd_summary,
+    "hottot":   cmd_whenhot,
+    "dong":     cmd_close,
+    "huy":      cmd_cancel,
+    "lammoi":   cmd_rebuild_summary,
+    "kiemtra":  cmd_check_summary,
+    "xuat":     cmd_export,
+    "lich":     cmd_calendar,
+}
+
+# callback_data prefix -> handler (inline keyboards)
+CALLBACKS = {
+    "ds": cb_list_page,
+}
+
 # ---------- MAIN (only used if you run locally with polling/webhook) ----------
+def _uow(handler):
+    # one pooled connection for the whole command, acquired off the event loop;
+    # each update gets its own metrics trace and log line. The chat lock is taken before
+    # the first await (asyncio.Lock queues waiters FIFO): connection acquires finish in any
+    # order on the DB threads, so ordering must not depend on them.
+    async def wrapped(upd, ctx):
+        chat = upd.effective_chat
+        async with chat_lock(chat.id if chat else 0):
+            with metrics.command(handler.__name__):
+                async with aunit_of_work():
+                    return await handler(upd, ctx)
+    return wrapped
+
+async def _reminder_loop():
+    # polling mode stand-in for /api/cron/reminders
+    from reminders import run_reminders
+    from reports import run_monthly
+    from outbox import drain
+    while True:
+        try:
+            await asyncio.to_thread(run_reminders)
+            await asyncio.to_thread(drain)
+            await asyncio.to_thread(run_monthly)
+        except Exception as e:
+            print("❌ Reminder tick error:", repr(e))
+        await asyncio.sleep(REMINDER_TICK_SECONDS)
+
+async def _post_init(app):
+    app.create_task(_reminder_loop())
+
 def main():
+    from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+    if not TOKEN:
+        raise SystemExit("Missing TELEGRAM_TOKEN/BOT_TOKEN in environment variables")
     init_tables_if_needed()
-    app = ApplicationBuilder().token(TOKEN).build()
-
-    app.add_handler(CommandHandler("start",    cmd_list))
-    app.add_handler(CommandHandler("lenh",     cmd_list))
-    app.add_handler(CommandHandler("baocao",   cmd_setreport))
-    app.add_handler(CommandHandler("tao",      lambda u,c: _create_line_and_reply(u, *c.args[:8])))
-    app.add_handler(CommandHandler("tham",     lambda u,c: _save_tham_msg(u, int(c.args[0]), int(c.args[1]), parse_money(c.args[2]), to_iso_str(parse_user_date(c.args[3])) if len(c.args)>=4 else None)))
-    app.add_handler(CommandHandler("hen",      cmd_set_remind))
-    app.add_handler(CommandHandler("danhsach", cmd_list))
-    app.add_handler(CommandHandler("tomtat",   cmd_summary))
-    app.add_handler(CommandHandler("hottot",   cmd_whenhot))
-    app.add_handler(CommandHandler("dong",     cmd_close))
-    app.add_handler(CommandHandler("huy",      cmd_cancel))
+    # independent chats run in parallel (chat_lock in _uow keeps each chat in order)
+    app = ApplicationBuilder().token(TOKEN).concurrent_updates(CONCURRENT_UPDATES).post_init(_post_init).build()
+
+    for name, handler in COMMANDS.items():
+        app.add_handler(CommandHandler(name, _uow(handler)))
+    # /nhap arrives as a document caption, which CommandHandler does not see
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/nhap(@\w+)?(\s|$)"), _uow(cmd_import)))
+    for prefix, handler in CALLBACKS.items():
+        app.add_handler(CallbackQueryHandler(_uow(handler), pattern=f"^{prefix}:"))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
 
     app.run_polling()
@@ -0,0 +1,69 @@
+# ===================== idempotency.py =====================
+# Dedupe webhook deliveries by update_id. Telegram redelivers an update when the
+# webhook is slow or fails; a claimed update_id is acknowledged without side effects.
+# Warm instances answer from an in-memory LRU; the processed_updates table covers
+# cold instances and concurrent deliveries.
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from db_pg import get_all, exec_sql
+
+DEDUPE_TTL_HOURS     = int(os.getenv("DEDUPE_TTL_HOURS", "48"))    # Telegram keeps undelivered updates 24h
+DEDUPE_LRU_SIZE      = int(os.getenv("DEDUPE_LRU_SIZE", "4096"))
+DEDUPE_CLEANUP_EVERY = float(os.getenv("DEDUPE_CLEANUP_EVERY", "600"))  # s between TTL sweeps per instance
+
+_seen = OrderedDict()
+_lock = threading.Lock()
+_last_cleanup = None
+stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "released": 0, "cleanups": 0}
+
+def _remember(update_id: int):
+    with _lock:
+        _seen[update_id] = True
+        _seen.move_to_end(update_id)
+        while len(_seen) > DEDUPE_LRU_SIZE:
+            _seen.popitem(last=False)
+
+def _maybe_cleanup():
+    global _last_cleanup
+    now = time.monotonic()
+    if _last_cleanup is not None and now - _last_cleanup < DEDUPE_CLEANUP_EVERY:
+        return
+    _last_cleanup = now
+    exec_sql("DELETE FROM processed_updates WHERE seen_at < NOW() - make_interval(hours => %s)", (DEDUPE_TTL_HOURS,))
+    stats["cleanups"] += 1
+
+def claim(update_id: int) -> bool:
+    """True if this update_id is new and should be processed, False for a redelivery."""
+    with _lock:
+        if update_id in _seen:
+            _seen.move_to_end(update_id)
+            stats["memory_hits"] += 1
+            return False
+    rows = get_all(
+        "INSERT INTO processed_updates(update_id) VALUES(%s) ON CONFLICT(update_id) DO NOTHING RETURNING update_id",
+        (update_id,)
+    )
+    _remember(update_id)
+    if not rows:
+        stats["db_hits"] += 1
+        return False
+    stats["misses"] += 1
+    _maybe_cleanup()
+    return True
+
+def release(update_id: int):
+    # processing failed: forget the claim so Telegram's retry runs the update again
+    with _lock:
+        _seen.pop(update_id, None)
+    exec_sql("DELETE FROM processed_updates WHERE update_id=%s", (update_id,))
+    stats["released"] += 1
+
+def dedupe_stats() -> dict:
+    hits = stats["memory_hits"] + stats["db_hits"]
+    total = hits + stats["misses"]
+    with _lock:
+        cached = len(_seen)
+    return {**stats, "cached": cached, "hit_ratio": (hits / total if total else 0.0)}
@@ -0,0 +1,220 @@
+# ===================== metrics.py =====================
+# In-process instrumentation (stdlib only, cheap to import on a cold start).
+# Histograms/counters are rendered in Prometheus text format by /api/metrics; they are
+# per instance, so on serverless the structured log line is the durable record.
+# A per-update trace (contextvar) collects DB and Telegram time; each request/update
+# emits one JSON log line with the breakdown: db, telegram, and the rest (compute).
+import os
+import sys
+import json
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+METRICS_LOG = os.getenv("METRICS_LOG", "1") != "0"   # one JSON line per request/update
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS   = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+PROCESS_START = time.time()
+_lock = threading.Lock()
+_registry: List["_Metric"] = []
+
+def _escape(value) -> str:
+    # exposition format: backslash, double quote and newline are escaped in label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(key: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str):
+        self.name, self.help = name, help
+        self.series: Dict[tuple, object] = {}
+        _registry.append(self)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with _lock:
+            items = sorted(self.series.items())
+        return self.header() + [f"{self.name}{_labels(k)} {v}" for k, v in items]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            s = self.series.get(key)
+            if s is None:
+                s = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]   # per-bucket, sum, count
+            s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    def render(self) -> List[str]:
+        with _lock:
+            items = sorted((k, (list(s[0]), s[1], s[2])) for k, s in self.series.items())
+        out = self.header()
+        for key, (counts, total, n) in items:
+            acc = 0
+            for b, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                le = 'le="+Inf"' if b == float("inf") else f'le="{b!r}"'
+                out.append(f"{self.name}_bucket{_labels(key, le)} {acc}")
+            out.append(f"{self.name}_sum{_labels(key)} {round(total, 6)}")
+            out.append(f"{self.name}_count{_labels(key)} {n}")
+        return out
+
+# ----- metrics -----
+HTTP_SECONDS     = Histogram("huibot_http_request_seconds", "HTTP request latency by route and status.")
+COMMAND_SECONDS  = Histogram("huibot_command_seconds", "Bot command handler latency.")
+COMMANDS_TOTAL   = Counter("huibot_commands_total", "Bot commands handled, by outcome.")
+UPDATES_TOTAL    = Counter("huibot_updates_total", "Requests/updates handled; cold = first of this process.")
+DB_QUERY_SECONDS = Histogram("huibot_db_query_seconds", "Time per DB statement (cursor.execute).")
+DB_QUERIES       = Histogram("huibot_db_queries_per_update", "DB statements per update.", COUNT_BUCKETS)
+DB_CONNECT       = Histogram("huibot_db_connect_seconds", "New Postgres connection setup time.")
+TG_SECONDS       = Histogram("huibot_telegram_call_seconds", "Outbound Bot API call latency by method.")
+TG_CALLS         = Counter("huibot_telegram_calls_total", "Outbound Bot API calls by method and HTTP status.")
+
+# ----- per-update trace -----
+_trace: contextvars.ContextVar = contextvars.ContextVar("metrics_trace", default=None)
+_served = 0
+_sinks: List[Callable[[dict], None]] = []
+
+def add_sink(fn: Callable[[dict], None]):
+    """Also hand every finished trace record to fn (e.g. scripts/bench.py)."""
+    _sinks.append(fn)
+
+def begin(**fields):
+    """Start a trace for this request/update; returns the token for end()."""
+    global _served
+    with _lock:
+        cold = _served == 0
+        _served += 1
+    t = {"t0": time.perf_counter(), "cold": cold, "command": None,
+         "db_queries": 0, "db_s": 0.0, "db_connect_s": 0.0, "tg_calls": 0, "tg_s": 0.0, **fields}
+    UPDATES_TOTAL.inc(cold=str(cold).lower())
+    return _trace.set(t)
+
+def end(token, **fields) -> dict:
+    t = _trace.get()
+    _trace.reset(token)
+    if t is None:
+        return {}
+    total = time.perf_counter() - t.pop("t0")
+    t.update(fields)
+    rec = {
+        **{k: v for k, v in t.items() if not k.endswith("_s")},
+        "ms": round(total * 1000, 2),
+        "db_ms": round(t["db_s"] * 1000, 2),
+        "db_connect_ms": round(t["db_connect_s"] * 1000, 2),
+        "tg_ms": round(t["tg_s"] * 1000, 2),
+        "other_ms": round((total - t["db_s"] - t["tg_s"]) * 1000, 2),   # compute + framework
+    }
+    if "route" in rec:
+        HTTP_SECONDS.observe(total, route=rec["route"], status=rec.get("status", ""))
+    if METRICS_LOG:
+        print(json.dumps({"evt": "request", **rec}, ensure_ascii=False, default=str))
+    for fn in _sinks:
+        fn(rec)
+    return rec
+
+@contextmanager
+def command(name: str):
+    """Time one bot command; starts (and logs) its own trace outside a request."""
+    own = _trace.get() is None
+    token = begin(kind="update") if own else None
+    t0 = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        COMMAND_SECONDS.observe(time.perf_counter() - t0, command=name)
+        COMMANDS_TOTAL.inc(command=name, outcome=outcome)
+        t = _trace.get()
+        if t is not None:
+            t["command"] = name
+            DB_QUERIES.observe(t["db_queries"])
+        if own:
+            end(token, outcome=outcome)
+
+def record_db(seconds: float):
+    DB_QUERY_SECONDS.observe(seconds)
+    t = _trace.get()
+    if t is not None:
+        t["db_queries"] += 1
+        t["db_s"] += seconds
+
+def record_connect(seconds: float):
+    DB_CONNECT.observe(seconds)
+    t = _trace.get()
+    if t is not None:
+        t["db_connect_s"] += seconds
+        t["db_s"] += seconds
+
+def record_tg(method: str, status: str, seconds: float):
+    TG_SECONDS.observe(seconds, method=method)
+    TG_CALLS.inc(method=method, status=status)
+    t = _trace.get()
+    if t is not None:
+        t["tg_calls"] += 1
+        t["tg_s"] += seconds
+
+# ----- exposition -----
+def _stats_gauges(name: str, stats: Dict[str, object], **labels) -> List[str]:
+    out = []
+    for k, v in sorted(stats.items()):
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            out.append(f"{name}{_labels(tuple(sorted({**labels, 'stat': k}.items())))} {v}")
+    return out
+
+def render() -> str:
+    """Prometheus text format. Pool/cache/dedupe stats come from modules this instance
+    has already loaded (a scrape never imports psycopg2 on its own)."""
+    out: List[str] = []
+    for m in _registry:
+        out += m.render()
+    out += ["# HELP huibot_process_start_time_seconds Unix time this instance started.",
+            "# TYPE huibot_process_start_time_seconds gauge",
+            f"huibot_process_start_time_seconds {PROCESS_START}"]
+    db = sys.modules.get("db_pg")
+    if db is not None:
+        out += ["# HELP huibot_db_pool Connection pool counters and sizes.", "# TYPE huibot_db_pool gauge"]
+        out += _stats_gauges("huibot_db_pool", db.pool_stats())
+    cache = sys.modules.get("cache")
+    if cache is not None:
+        out += ["# HELP huibot_cache Read-through cache counters.", "# TYPE huibot_cache gauge"]
+        for name, stats in cache.cache_stats().items():
+            out += _stats_gauges("huibot_cache", stats, cache=name)
+    dedupe = sys.modules.get("idempotency")
+    if dedupe is not None:
+        out += ["# HELP huibot_dedupe Webhook update_id dedupe counters.", "# TYPE huibot_dedupe gauge"]
+        out += _stats_gauges("huibot_dedupe", dedupe.dedupe_stats())
+    return "\n".join(out) + "\n"
@@ -0,0 +1,222 @@
+# ===================== migrations.py =====================
+# Versioned schema migrations. Each step runs once, in order, and is recorded in
+# schema_version; steps use IF NOT EXISTS so databases created by the old init_db
+# (no schema_version table yet) replay them safely. A current schema costs one
+# SELECT. Pending steps run in one transaction under an advisory lock, so concurrent
+# cold starts wait for the first one instead of racing the same DDL.
+import os
+from typing import List, Tuple, Union
+
+import psycopg2
+import psycopg2.errors
+
+from db_pg import connection, unit_of_work
+
+MIGRATION_LOCK_KEY = 7_402_118_301   # pg_advisory_xact_lock key, shared by every instance
+
+Statement = Union[str, Tuple[str, tuple]]
+
+MIGRATIONS: List[Tuple[int, str, List[Statement]]] = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS lines(
+            id           BIGSERIAL PRIMARY KEY,
+            name         TEXT NOT NULL,
+            period_days  INTEGER NOT NULL,
+            start_date   DATE NOT NULL,
+            legs         INTEGER NOT NULL,
+            contrib      BIGINT NOT NULL,
+            bid_type     TEXT DEFAULT 'dynamic',
+            bid_value    DOUBLE PRECISION DEFAULT 0,
+            status       TEXT DEFAULT 'OPEN',
+            created_at   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            base_rate    DOUBLE PRECISION DEFAULT 0,
+            cap_rate     DOUBLE PRECISION DEFAULT 100,
+            thau_rate    DOUBLE PRECISION DEFAULT 0,
+            remind_hour  INTEGER DEFAULT 8,
+            remind_min   INTEGER DEFAULT 0,
+            last_remind_iso DATE
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payments(
+            id BIGSERIAL PRIMARY KEY,
+            line_id BIGINT NOT NULL REFERENCES lines(id) ON DELETE CASCADE,
+            pay_date DATE NOT NULL,
+            amount   BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rounds(
+            id BIGSERIAL PRIMARY KEY,
+            line_id BIGINT NOT NULL REFERENCES lines(id) ON DELETE CASCADE,
+            k       INTEGER NOT NULL,
+            bid     BIGINT NOT NULL,
+            round_date DATE,
+            UNIQUE(line_id, k)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS configs(
+            key   TEXT PRIMARY KEY,
+            value JSONB NOT NULL
+        )
+        """,
+    ]),
+    (2, "line owner chat", [
+        "ALTER TABLE lines ADD COLUMN IF NOT EXISTS chat_id BIGINT",
+        "CREATE INDEX IF NOT EXISTS lines_chat_idx ON lines(chat_id, id DESC)",
+        "CREATE INDEX IF NOT EXISTS lines_chat_status_idx ON lines(chat_id, status, id DESC)",
+        # lines created before ownership: BACKFILL_CHAT_ID, else the /baocao chat
+        ("""
+        UPDATE lines SET chat_id = COALESCE(
+            NULLIF(%s, '')::BIGINT,
+            (SELECT (value->>'report_chat_id')::BIGINT FROM configs WHERE key='bot_cfg')
+        )
+        WHERE chat_id IS NULL
+        """, (os.getenv("BACKFILL_CHAT_ID", "").strip(),)),
+    ]),
+    (3, "line summary", [
+        """
+        CREATE TABLE IF NOT EXISTS line_summary(
+            line_id            BIGINT PRIMARY KEY REFERENCES lines(id) ON DELETE CASCADE,
+            n_bids             INTEGER NOT NULL,
+            bids               BIGINT[] NOT NULL,
+            k_now              INTEGER NOT NULL,
+            payout_now         BIGINT NOT NULL,
+            paid_now           BIGINT NOT NULL,
+            profit_now         BIGINT NOT NULL,
+            roi_now            DOUBLE PRECISION NOT NULL,
+            best_roi_k         INTEGER NOT NULL,
+            best_roi_payout    BIGINT NOT NULL,
+            best_roi_paid      BIGINT NOT NULL,
+            best_roi_profit    BIGINT NOT NULL,
+            best_roi           DOUBLE PRECISION NOT NULL,
+            best_profit_k      INTEGER NOT NULL,
+            best_profit_payout BIGINT NOT NULL,
+            best_profit_paid   BIGINT NOT NULL,
+            best_profit        BIGINT NOT NULL,
+            best_profit_roi    DOUBLE PRECISION NOT NULL,
+            next_round_date    DATE NOT NULL,
+            pay_count          INTEGER NOT NULL DEFAULT 0,
+            pay_total          BIGINT NOT NULL DEFAULT 0,
+            list_row           TEXT NOT NULL,
+            updated_at         TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            version            BIGINT NOT NULL DEFAULT 1
+        )
+        """,
+        "ALTER TABLE line_summary ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1",
+    ]),
+    (4, "webhook dedupe", [
+        """
+        CREATE TABLE IF NOT EXISTS processed_updates(
+            update_id BIGINT PRIMARY KEY,
+            seen_at   TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS processed_updates_seen_idx ON processed_updates(seen_at)",
+    ]),
+    (5, "outbox", [
+        """
+        CREATE TABLE IF NOT EXISTS outbox(
+            id         BIGSERIAL PRIMARY KEY,
+            chat_id    BIGINT NOT NULL,
+            text       TEXT NOT NULL,
+            status     TEXT NOT NULL DEFAULT 'PENDING',
+            attempts   INTEGER NOT NULL DEFAULT 0,
+            not_before TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            sent_at    TIMESTAMPTZ,
+            last_error TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS outbox_pending_idx ON outbox(not_before, id) WHERE status='PENDING'",
+    ]),
+    (6, "lookup indexes", [
+        # payment history per line (snapshot aggregates, exports)
+        "CREATE INDEX IF NOT EXISTS payments_line_date_idx ON payments(line_id, pay_date)",
+        # reminder tick: due-line selection (see reminders.py)
+        "CREATE INDEX IF NOT EXISTS lines_remind_idx ON lines(status, remind_hour, remind_min, last_remind_iso)",
+    ]),
+    (7, "round schedule", [
+        # one row per round of every OPEN line, kept by hui_bot_fresh.refresh_line_summaries;
+        # existing lines are filled lazily by calendar_rows (a backfill here could outlast the
+        # request that runs the migration on a large database)
+        """
+        CREATE TABLE IF NOT EXISTS round_schedule(
+            line_id       BIGINT NOT NULL REFERENCES lines(id) ON DELETE CASCADE,
+            k             INTEGER NOT NULL,
+            chat_id       BIGINT,
+            due_date      DATE NOT NULL,
+            pay_amount    BIGINT NOT NULL,
+            payout_amount BIGINT NOT NULL,
+            suggested     BOOLEAN NOT NULL DEFAULT FALSE,
+            PRIMARY KEY(line_id, k)
+        )
+        """,
+        # /lich: one range scan per chat and date window
+        "CREATE INDEX IF NOT EXISTS round_schedule_chat_due_idx ON round_schedule(chat_id, due_date) "
+        "INCLUDE (pay_amount, payout_amount, suggested)",
+    ]),
+    (8, "config version", [
+        # bumped by cfg_set; warm instances revalidate their cached config against it
+        "ALTER TABLE configs ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(cur) -> int:
+    try:
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return int(cur.fetchone()[0])
+    except psycopg2.errors.UndefinedTable:
+        cur.connection.rollback()
+        return 0
+
+def _run(cur, stmt: Statement):
+    if isinstance(stmt, tuple):
+        cur.execute(*stmt)
+    else:
+        cur.execute(stmt)
+
+def migrate() -> List[int]:
+    """Apply pending migrations; returns the versions applied by this call."""
+    with connection() as conn:
+        cur = conn.cursor()
+        version = current_version(cur)
+        cur.close()
+    if version >= LATEST_VERSION:
+        return []
+    applied = []
+    with unit_of_work(transaction=True) as conn:
+        cur = conn.cursor()
+        # held until commit; a concurrent cold start blocks here, then sees the new version
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_KEY,))
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version(
+            version    INTEGER PRIMARY KEY,
+            name       TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """)
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        version = int(cur.fetchone()[0])
+        for number, name, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            for stmt in statements:
+                _run(cur, stmt)
+            cur.execute("INSERT INTO schema_version(version, name) VALUES(%s, %s)", (number, name))
+            applied.append(number)
+        if 2 in applied:
+            # no BACKFILL_CHAT_ID and no /baocao chat: these lines are visible to no chat
+            cur.execute("SELECT COUNT(*) FROM lines WHERE chat_id IS NULL")
+            unowned = int(cur.fetchone()[0])
+            if unowned:
+                print(f"⚠️ {unowned} line(s) have no owner chat; set chat_id by hand "
+                      f"(UPDATE lines SET chat_id=<chat_id> WHERE chat_id IS NULL)")
+        cur.close()
+    if applied:
+        print(f"🗄️ Schema migrated to v{applied[-1]} (applied {applied})")
+    return applied
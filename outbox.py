@@ -0,0 +1,249 @@
+# ===================== outbox.py =====================
+# Durable outbound message queue for fan-out (reminders, reports).
+# Messages are queued in the outbox table and sent by drain() under Telegram's limits:
+# a global token bucket (~30 msg/s) and one bucket per chat (~1 msg/s), pausing a chat
+# for retry_after on 429. Pending rows for the same chat are merged into one message
+# up to the 4096-char limit, so a burst to one chat costs one API call per 4 KB.
+import os
+import time
+import heapq
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from db_pg import get_all, exec_sql, connection
+from hui_bot_fresh import split_message, TG_TEXT_LIMIT
+import psycopg2.extras
+
+OUTBOX_GLOBAL_RATE   = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))    # msg/s across all chats
+OUTBOX_CHAT_RATE     = float(os.getenv("OUTBOX_CHAT_RATE", "1"))       # msg/s per chat
+OUTBOX_BATCH         = int(os.getenv("OUTBOX_BATCH", "500"))           # rows claimed per round
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "60"))    # claimed rows hidden from other drainers
+OUTBOX_MAX_ATTEMPTS  = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_MAX_SECONDS   = float(os.getenv("OUTBOX_MAX_SECONDS", "20"))
+MERGE_SEP = "\n\n"
+
+class TokenBucket:
+    """Classic token bucket; pause() blocks it until a 429's retry_after has passed."""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "paused_until")
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, now: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic() if now is None else now
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now: float, seconds: float):
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0.0
+        self.updated = now
+
+# ----- enqueue -----
+def enqueue(chat_id: int, text: str):
+    exec_sql("INSERT INTO outbox(chat_id, text) VALUES(%s, %s)", (chat_id, text))
+
+def enqueue_many(items: Iterable[Tuple[int, str]]):
+    items = list(items)
+    if not items:
+        return
+    with connection() as conn:
+        cur = conn.cursor()
+        psycopg2.extras.execute_values(cur, "INSERT INTO outbox(chat_id, text) VALUES %s", items, page_size=1000)
+        cur.close()
+
+# ----- coalescing -----
+def coalesce(rows: List[dict], limit: int = TG_TEXT_LIMIT) -> List[Tuple[List[int], str]]:
+    """Merge consecutive rows (same chat, id order) into messages <= limit; returns [(row_ids, text)]."""
+    out: List[Tuple[List[int], str]] = []
+    ids: List[int] = []
+    cur = ""
+    for r in rows:
+        parts = split_message(r["text"], limit)
+        if len(parts) > 1:
+            if ids: out.append((ids, cur)); ids, cur = [], ""
+            # the row is done only when its last chunk is sent
+            out.extend(([], p) for p in parts[:-1])
+            out.append(([r["id"]], parts[-1]))
+            continue
+        text = parts[0]
+        if ids and len(cur) + len(MERGE_SEP) + len(text) > limit:
+            out.append((ids, cur)); ids, cur = [], ""
+        ids.append(r["id"])
+        cur = f"{cur}{MERGE_SEP}{text}" if cur else text
+    if ids:
+        out.append((ids, cur))
+    return out
+
+# ----- drain -----
+_CLAIM_SQL = """
+UPDATE outbox SET not_before = NOW() + make_interval(secs => %s), attempts = attempts + 1
+WHERE id IN (
+    SELECT id FROM outbox
+    WHERE status = 'PENDING' AND not_before <= NOW()
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, chat_id, text, attempts
+"""
+
+def _claim(limit: int) -> List[dict]:
+    rows = get_all(_CLAIM_SQL, (OUTBOX_LEASE_SECONDS, limit))
+    rows.sort(key=lambda r: r["id"])
+    return rows
+
+def _mark_sent(ids: List[int]):
+    if ids:
+        exec_sql("UPDATE outbox SET status='SENT', sent_at=NOW() WHERE id = ANY(%s)", (ids,))
+
+def _mark_failed(ids: List[int], error: str):
+    if ids:
+        exec_sql("UPDATE outbox SET status='FAILED', last_error=%s WHERE id = ANY(%s)", (error[:500], ids))
+
+def _retry_later(ids: List[int], seconds: float, error: Optional[str] = None):
+    # back to PENDING after `seconds`; gives up for rows past OUTBOX_MAX_ATTEMPTS
+    if not ids:
+        return
+    exec_sql(
+        """
+        UPDATE outbox SET
+            not_before = NOW() + make_interval(secs => %s),
+            last_error = COALESCE(%s, last_error),
+            status = CASE WHEN %s AND attempts >= %s THEN 'FAILED' ELSE status END
+        WHERE id = ANY(%s)
+        """,
+        (float(seconds), error and error[:500], error is not None, OUTBOX_MAX_ATTEMPTS, ids)
+    )
+
+def _unclaim(ids: List[int]):
+    # not attempted in this invocation: release the lease, do not count the attempt
+    if ids:
+        exec_sql("UPDATE outbox SET not_before=NOW(), attempts=GREATEST(attempts-1, 0) WHERE id = ANY(%s)", (ids,))
+
+def _send(chat_id: int, text: str) -> Tuple[str, float, str]:
+    """Returns (outcome, retry_after, error) with outcome in ok | limited | retry | fail."""
+    from adapter_huibot import send_message
+    try:
+        resp = send_message(chat_id, text)
+    except Exception as e:                      # network/timeout: try again later
+        return "retry", 5.0, repr(e)
+    if resp.status_code == 200:
+        return "ok", 0.0, ""
+    try:
+        body = resp.json()
+    except Exception:
+        body = {}
+    desc = body.get("description") or resp.text[:200]
+    if resp.status_code == 429:
+        return "limited", float((body.get("parameters") or {}).get("retry_after", 1)), desc
+    if resp.status_code >= 500:
+        return "retry", 5.0, desc
+    return "fail", 0.0, desc                    # 400 chat not found, 403 bot blocked, ...
+
+_chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+_global_bucket: Optional[TokenBucket] = None
+
+def _chat_bucket(chat_id: int, now: float) -> TokenBucket:
+    b = _chat_buckets.get(chat_id)
+    if b is None:
+        b = _chat_buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, 1.0, now)
+        while len(_chat_buckets) > 10000:
+            _chat_buckets.popitem(last=False)
+    return b
+
+def drain(max_seconds: float = OUTBOX_MAX_SECONDS, sleep=time.sleep) -> Dict[str, object]:
+    """Send pending messages until the queue is empty or max_seconds is used up."""
+    global _global_bucket
+    t0 = time.monotonic()
+    deadline = t0 + max_seconds
+    if _global_bucket is None:
+        # capacity 1: paced evenly, never more than OUTBOX_GLOBAL_RATE in any one-second window
+        _global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, 1.0, t0)
+    stats = {"claimed": 0, "api_calls": 0, "sent_rows": 0, "retried_rows": 0, "failed_rows": 0,
+             "rate_limited": 0, "deferred_rows": 0, "done": True}
+
+    while stats["done"] and time.monotonic() < deadline:
+        rows = _claim(OUTBOX_BATCH)
+        if not rows:
+            break
+        stats["claimed"] += len(rows)
+        queues: "OrderedDict[int, List[Tuple[List[int], str]]]" = OrderedDict()
+        by_chat: Dict[int, List[dict]] = {}
+        for r in rows:
+            by_chat.setdefault(int(r["chat_id"]), []).append(r)
+        for cid, rs in by_chat.items():
+            queues[cid] = coalesce(rs)
+
+        # heap of (ready_at, seq, chat): the chat whose bucket frees up first goes next
+        now = time.monotonic()
+        heap = [(now + _chat_bucket(cid, now).wait_time(now), i, cid) for i, cid in enumerate(queues)]
+        heapq.heapify(heap)
+        seq = len(heap)
+        sent_ids: List[int] = []
+        while heap:
+            _, _, cid = heapq.heappop(heap)
+            now = time.monotonic()
+            bucket = _chat_bucket(cid, now)
+            chat_wait = bucket.wait_time(now)
+            if chat_wait > 0 and heap and now + chat_wait > heap[0][0]:
+                # stale entry and another chat frees up sooner: requeue at the real ready time
+                seq += 1
+                heapq.heappush(heap, (now + chat_wait, seq, cid))
+                continue
+            wait = max(chat_wait, _global_bucket.wait_time(now))
+            if now + wait > deadline:
+                left = [i for ids, _ in queues[cid] for i in ids]
+                left += [i for _, _, other in heap for ids, _ in queues[other] for i in ids]
+                _unclaim(left)
+                stats["deferred_rows"] += len(left)
+                stats["done"] = False
+                break
+            if wait > 0:
+                sleep(wait)
+                now = time.monotonic()
+            ids, text = queues[cid].pop(0)
+            _global_bucket.take(now); bucket.take(now)
+            outcome, retry_after, err = _send(cid, text)
+            stats["api_calls"] += 1
+            if outcome == "ok":
+                sent_ids += ids
+                stats["sent_rows"] += len(ids)
+                if len(sent_ids) >= 50:          # bound re-sends if the invocation dies mid-batch
+                    _mark_sent(sent_ids); sent_ids = []
+            elif outcome in ("limited", "retry"):
+                if outcome == "limited":
+                    stats["rate_limited"] += 1
+                bucket.pause(time.monotonic(), retry_after)
+                pending = ids + [i for rest, _ in queues[cid] for i in rest]
+                _retry_later(pending, retry_after, None if outcome == "limited" else err)
+                stats["retried_rows"] += len(pending)
+                queues[cid] = []
+            else:
+                _mark_failed(ids, err)
+                stats["failed_rows"] += len(ids)
+            if queues[cid]:
+                now = time.monotonic()
+                seq += 1
+                heapq.heappush(heap, (now + bucket.wait_time(now), seq, cid))
+        _mark_sent(sent_ids)
+
+    stats["ms"] = round((time.monotonic() - t0) * 1000, 1)
+    return stats
+
+def outbox_stats() -> Dict[str, int]:
+    rows = get_all("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status")
+    return {r["status"]: int(r["n"]) for r in rows}
@@ -0,0 +1,118 @@
+# ===================== payout_engine.py =====================
+# O(N) payout / paid / profit / ROI for every k of a line, from prefix sums of (M - bid).
+# Same results as payout_at_k / paid_so_far_if_win_at_k / compute_profit_var in hui_bot_fresh,
+# without re-summing earlier bids for each k. NumPy is used for large batches when installed.
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+Bids = Union[Dict[int, int], Sequence[Optional[int]]]
+
+NUMPY_MIN_CELLS = 4096      # below this the pure-Python loop is faster than NumPy setup
+_NP_UNSET = object()
+_np = _NP_UNSET
+
+def _numpy():
+    # imported lazily: keeps numpy off the cold-start path
+    global _np
+    if _np is _NP_UNSET:
+        try:
+            import numpy
+            _np = numpy
+        except ImportError:
+            _np = None
+    return _np
+
+def _line_params(line) -> Tuple[int, int, int]:
+    M, N = int(line["contrib"]), int(line["legs"])
+    D = int(round(M * float(line.get("thau_rate", 0)) / 100.0))
+    return M, N, D
+
+def _bid_list(bids: Bids, N: int) -> List[int]:
+    # dense T[0..N] (T[0] unused); accepts a {k: bid} dict or a LineSnapshot-style list
+    T = [0] * (N + 1)
+    if isinstance(bids, dict):
+        for k, b in bids.items():
+            if 1 <= int(k) <= N: T[int(k)] = int(b)
+    else:
+        for k in range(1, min(N + 1, len(bids))):
+            if bids[k] is not None: T[k] = int(bids[k])
+    return T
+
+class PayoutTable:
+    """Per-k columns for one line; index k-1 holds round k."""
+    __slots__ = ("payout", "paid", "profit", "roi")
+
+    def __init__(self, payout, paid, profit, roi):
+        self.payout, self.paid, self.profit, self.roi = payout, paid, profit, roi
+
+    def row(self, k: int):
+        # same tuple order as compute_profit_var: (profit, roi, payout, paid)
+        i = k - 1
+        return self.profit[i], self.roi[i], self.payout[i], self.paid[i]
+
+    def best(self, metric: str = "roi"):
+        key = self.roi if metric == "roi" else self.profit
+        bestk, bestkey = 1, -1e18
+        for i, v in enumerate(key):
+            if v > bestkey:
+                bestk, bestkey = i + 1, v
+        return bestk, (self.row(bestk) if bestkey > -1e18 else None)
+
+def payout_table(line, bids: Bids) -> PayoutTable:
+    M, N, D = _line_params(line)
+    T = _bid_list(bids, N)
+    payout, paid_col, profit, roi = [], [], [], []
+    paid = 0
+    for k in range(1, N + 1):
+        po = (k-1)*M + (N - k)*(M - T[k]) - D
+        p = po - paid
+        base = paid if paid > 0 else M
+        payout.append(po); paid_col.append(paid); profit.append(p)
+        roi.append(p / base if base else 0.0)
+        paid += M - T[k]
+    return PayoutTable(payout, paid_col, profit, roi)
+
+def best_k(line, bids: Bids, metric: str = "roi"):
+    return payout_table(line, bids).best(metric)
+
+def _best_k_numpy(np, items, metric: str):
+    params = [_line_params(line) for line, _ in items]
+    Nmax = max(N for _, N, _ in params)
+    L = len(items)
+    T = np.zeros((L, Nmax + 1), dtype=np.int64)
+    for i, ((_, bids), (_, N, _)) in enumerate(zip(items, params)):
+        T[i, :N + 1] = _bid_list(bids, N)
+    T = T[:, 1:]
+    M = np.array([p[0] for p in params], dtype=np.int64)[:, None]
+    N = np.array([p[1] for p in params], dtype=np.int64)[:, None]
+    D = np.array([p[2] for p in params], dtype=np.int64)[:, None]
+    k = np.arange(1, Nmax + 1, dtype=np.int64)[None, :]
+
+    contrib = M - T
+    paid = np.zeros_like(contrib)
+    np.cumsum(contrib[:, :-1], axis=1, out=paid[:, 1:])
+    payout = (k - 1)*M + (N - k)*contrib - D
+    profit = payout - paid
+    base = np.where(paid > 0, paid, M)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        roi = np.where(base != 0, profit / np.where(base != 0, base, 1), 0.0)
+
+    key = (roi if metric == "roi" else profit).astype(np.float64)
+    key[k.repeat(L, axis=0) > N] = -np.inf
+    idx = key.argmax(axis=1)
+    out = []
+    for i, j in enumerate(idx):
+        if not key[i, j] > -1e18:
+            out.append((1, None)); continue
+        out.append((int(j) + 1, (int(profit[i, j]), float(roi[i, j]), int(payout[i, j]), int(paid[i, j]))))
+    return out
+
+def best_k_many(items: Iterable[Tuple[dict, Bids]], metric: str = "roi"):
+    """Best k for many (line, bids) pairs in one batched call; returns [(k, info), ...] in input order."""
+    items = list(items)
+    if not items:
+        return []
+    np = _numpy()
+    cells = sum(int(line["legs"]) for line, _ in items)
+    if np is not None and cells >= NUMPY_MIN_CELLS:
+        return _best_k_numpy(np, items, metric)
+    return [best_k(line, bids, metric) for line, bids in items]
@@ -0,0 +1,100 @@
+# ===================== reminders.py =====================
+# Reminder tick for /api/cron/reminders (and the polling loop in hui_bot_fresh.main).
+# Due lines are picked set-based in SQL: OPEN, reminder time reached, not yet reminded
+# today, and today is one of the line's round dates (k_date == today). Matching rows are
+# read in keyset batches; each batch is queued in the outbox (to the line's owner chat)
+# and marked with one UPDATE ... WHERE id = ANY(...) in the same transaction.
+# outbox.drain() does the sending.
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from db_pg import get_all, exec_sql, unit_of_work
+from outbox import enqueue_many, TG_TEXT_LIMIT
+from hui_bot_fresh import load_cfg, now_local, to_iso_str, to_user_str, k_date
+
+REMINDER_BATCH       = int(os.getenv("REMINDER_BATCH", "1000"))
+REMINDER_MAX_SECONDS = float(os.getenv("REMINDER_MAX_SECONDS", "20"))   # stay inside the function limit
+
+# served by lines_remind_idx (status, remind_hour, remind_min, last_remind_iso)
+_DUE_SQL = """
+SELECT id, chat_id, name, start_date, period_days, legs, contrib, remind_hour, remind_min,
+       (%(today)s::date - start_date) / period_days + 1 AS k
+FROM lines
+WHERE status = 'OPEN'
+  AND (remind_hour, remind_min) <= (%(hh)s, %(mm)s)
+  AND (last_remind_iso IS NULL OR last_remind_iso < %(today)s::date)
+  AND start_date <= %(today)s::date
+  AND (%(today)s::date - start_date) %% period_days = 0
+  AND (%(today)s::date - start_date) / period_days < legs
+  AND id > %(after)s
+ORDER BY id
+LIMIT %(limit)s
+"""
+
+def due_lines(now: datetime, after: int = 0, limit: int = REMINDER_BATCH) -> List[dict]:
+    return get_all(_DUE_SQL, {"today": to_iso_str(now), "hh": now.hour, "mm": now.minute,
+                              "after": after, "limit": limit})
+
+def mark_reminded(line_ids: List[int], day_iso: str):
+    if line_ids:
+        exec_sql("UPDATE lines SET last_remind_iso=%s WHERE id = ANY(%s)", (day_iso, list(line_ids)))
+
+def reminder_line(r: dict) -> str:
+    k = int(r["k"])
+    return (f"⏰ Dây #{r['id']} · {r['name']} · kỳ {k}/{r['legs']} · hôm nay {to_user_str(k_date(r, k))} · "
+            f"M {int(r['contrib']):,} VND")
+
+def _pack(lines: List[str], limit: int = TG_TEXT_LIMIT) -> List[str]:
+    # join reminders into as few messages as fit Telegram's text limit
+    out, cur = [], ""
+    for ln in lines:
+        if cur and len(cur) + 1 + len(ln) > limit:
+            out.append(cur); cur = ""
+        cur = f"{cur}\n{ln}" if cur else ln
+    if cur: out.append(cur)
+    return out
+
+def _queue(by_chat: Dict[int, List[str]]) -> int:
+    items = [(chat_id, text) for chat_id, lines in by_chat.items()
+             for text in _pack(["🔔 Nhắc hụi hôm nay:"] + lines)]
+    enqueue_many(items)
+    return len(items)
+
+def run_reminders(now: Optional[datetime] = None) -> Dict[str, object]:
+    t0 = time.monotonic()
+    now = now or now_local()
+    today = to_iso_str(now)
+    stats = {"date": today, "due": 0, "marked": 0, "messages": 0, "batches": 0, "done": True}
+    # each line reminds its owner chat; the /baocao chat covers lines without one
+    fallback = load_cfg().get("report_chat_id")
+    stats["skipped"] = 0
+    after = 0
+    while True:
+        if time.monotonic() - t0 > REMINDER_MAX_SECONDS:
+            stats["done"] = False      # next tick picks up the rest (they are still unmarked)
+            break
+        rows = due_lines(now, after=after)
+        if not rows:
+            break
+        stats["batches"] += 1
+        stats["due"] += len(rows)
+        by_chat: Dict[int, List[str]] = {}
+        ids = []
+        for r in rows:
+            dest = r["chat_id"] or fallback
+            if not dest:
+                stats["skipped"] += 1
+                continue
+            by_chat.setdefault(int(dest), []).append(reminder_line(r))
+            ids.append(int(r["id"]))
+        with unit_of_work(transaction=True):
+            stats["messages"] += _queue(by_chat)
+            mark_reminded(ids, today)
+        stats["marked"] += len(ids)
+        after = int(rows[-1]["id"])
+        if len(rows) < REMINDER_BATCH:
+            break
+    stats["ms"] = round((time.monotonic() - t0) * 1000, 1)
+    return stats
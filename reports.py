@@ -0,0 +1,252 @@
+# ===================== reports.py =====================
+# Monthly portfolio report for /api/cron/monthly and /xuat.
+# Totals are aggregated in SQL. Per-line export rows stream from a server-side cursor
+# straight into a CSV (or XLSX, if openpyxl is installed) spooled to disk past
+# REPORT_SPOOL_BYTES, so memory stays flat as payment history grows. Each chat gets
+# one sendDocument with the month's totals as the caption.
+import io
+import os
+import csv
+import time
+import codecs
+from datetime import date, datetime
+from tempfile import SpooledTemporaryFile
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from db_pg import get_all, stream_rows, cfg_get, cfg_set
+from hui_bot_fresh import REPORT_HOUR, now_local
+
+REPORT_CHUNK       = int(os.getenv("REPORT_CHUNK", "1000"))                    # rows per cursor fetch
+REPORT_SPOOL_BYTES = int(os.getenv("REPORT_SPOOL_BYTES", str(1024 * 1024)))   # in memory up to this, then disk
+REPORT_BATCH       = int(os.getenv("REPORT_BATCH", "200"))                     # chats per totals query
+REPORT_MAX_SECONDS = float(os.getenv("REPORT_MAX_SECONDS", "20"))
+CAPTION_LIMIT = 1024
+STATE_KEY = "monthly_report"   # configs: {"month", "after" (last chat sent), "done"}
+
+# ----- months -----
+def parse_month(s: str) -> str:
+    """MM-YYYY, M/YYYY or YYYY-MM -> 'YYYY-MM'."""
+    try:
+        a, b = s.strip().replace("/", "-").split("-")
+        y, m = (int(a), int(b)) if len(a) == 4 else (int(b), int(a))
+        datetime(y, m, 1)
+    except ValueError:
+        raise ValueError(f"Không hiểu tháng: {s}")
+    return f"{y:04d}-{m:02d}"
+
+def month_range(month: str) -> Tuple[date, date]:
+    y, m = map(int, month.split("-"))
+    return date(y, m, 1), (date(y + 1, 1, 1) if m == 12 else date(y, m + 1, 1))
+
+def previous_month(now: datetime) -> str:
+    y, m = (now.year - 1, 12) if now.month == 1 else (now.year, now.month - 1)
+    return f"{y:04d}-{m:02d}"
+
+def user_month(month: str) -> str:
+    y, m = month.split("-")
+    return f"{m}-{y}"
+
+# ----- SQL -----
+# rounds_due: round dates start + g*period (0 <= g < legs) inside [m0, m1), by arithmetic.
+# `chats` picks the batch first (keyset on lines_chat_idx), so payments and rounds are only
+# aggregated for the batch's lines and each batch costs the same however many chats follow it.
+_TOTALS_SQL = """
+WITH chats AS (
+    SELECT DISTINCT chat_id FROM lines
+    WHERE chat_id IS NOT NULL AND (%(after)s::bigint IS NULL OR chat_id > %(after)s)
+      AND (%(chat)s::bigint IS NULL OR chat_id = %(chat)s)
+    ORDER BY chat_id
+    LIMIT %(limit)s
+), pay AS (
+    SELECT p.line_id, COUNT(*) AS n, SUM(p.amount) AS total
+    FROM chats c JOIN lines x ON x.chat_id = c.chat_id JOIN payments p ON p.line_id = x.id
+    WHERE p.pay_date >= %(m0)s AND p.pay_date < %(m1)s
+    GROUP BY p.line_id
+), bid AS (
+    SELECT r.line_id, COUNT(*) AS n
+    FROM chats c JOIN lines x ON x.chat_id = c.chat_id JOIN rounds r ON r.line_id = x.id
+    WHERE x.start_date + (r.k - 1) * x.period_days >= %(m0)s
+      AND x.start_date + (r.k - 1) * x.period_days <  %(m1)s
+    GROUP BY r.line_id
+)
+SELECT l.chat_id,
+       COUNT(*) FILTER (WHERE l.status = 'OPEN')  AS open_lines,
+       COUNT(*) FILTER (WHERE l.status <> 'OPEN') AS closed_lines,
+       COALESCE(SUM(l.contrib) FILTER (WHERE l.status = 'OPEN'), 0) AS open_contrib,
+       COALESCE(SUM(GREATEST(0,
+           LEAST(l.legs - 1, FLOOR(((%(m1)s::date - 1) - l.start_date)::numeric / l.period_days))
+           - GREATEST(0, CEIL((%(m0)s::date - l.start_date)::numeric / l.period_days)) + 1
+       )) FILTER (WHERE l.status = 'OPEN'), 0) AS rounds_due,
+       COALESCE(SUM(bid.n), 0)   AS rounds_bid,
+       COALESCE(SUM(pay.n), 0)     AS pay_count,
+       COALESCE(SUM(pay.total), 0) AS pay_total,
+       COALESCE(SUM(s.paid_now)   FILTER (WHERE l.status = 'OPEN'), 0) AS paid_now,
+       COALESCE(SUM(s.profit_now) FILTER (WHERE l.status = 'OPEN'), 0) AS profit_now
+FROM chats c
+JOIN lines l ON l.chat_id = c.chat_id
+LEFT JOIN line_summary s ON s.line_id = l.id
+LEFT JOIN pay ON pay.line_id = l.id
+LEFT JOIN bid ON bid.line_id = l.id
+GROUP BY l.chat_id
+ORDER BY l.chat_id
+"""
+
+_LINES_SQL = """
+WITH pay AS (
+    SELECT p.line_id, COUNT(*) AS n, SUM(p.amount) AS total
+    FROM payments p JOIN lines x ON x.id = p.line_id AND x.chat_id = %(chat)s
+    WHERE p.pay_date >= %(m0)s AND p.pay_date < %(m1)s
+    GROUP BY p.line_id
+)
+SELECT l.id, l.name, l.status, l.start_date, l.period_days, l.legs, l.contrib,
+       COALESCE(s.n_bids, 0), s.k_now, s.next_round_date,
+       COALESCE(s.paid_now, 0), COALESCE(s.payout_now, 0), COALESCE(s.profit_now, 0),
+       ROUND(COALESCE(s.roi_now, 0)::numeric, 4),
+       COALESCE(pay.n, 0), COALESCE(pay.total, 0), COALESCE(s.pay_count, 0), COALESCE(s.pay_total, 0)
+FROM lines l
+LEFT JOIN line_summary s ON s.line_id = l.id
+LEFT JOIN pay ON pay.line_id = l.id
+WHERE l.chat_id = %(chat)s
+ORDER BY l.id
+"""
+
+EXPORT_HEADER = [
+    "ma_day", "ten", "trang_thai", "ngay_mo", "chu_ky_ngay", "so_chan", "menh_gia",
+    "so_tham", "ky_hien_tai", "ky_toi", "da_dong", "nhan_neu_hot", "lai", "roi",
+    "lan_dong_trong_thang", "tien_dong_trong_thang", "tong_lan_dong", "tong_tien_dong",
+]
+
+def chat_totals(month: str, chat_id: Optional[int] = None, after: Optional[int] = None,
+                limit: int = REPORT_BATCH) -> List[dict]:
+    """Per-chat totals ordered by chat_id; `after` is the keyset cursor (None = from the start:
+    group and supergroup ids are negative, so there is no "below every chat" number)."""
+    m0, m1 = month_range(month)
+    if chat_id is not None:
+        after = None
+    return get_all(_TOTALS_SQL, {"m0": m0, "m1": m1, "chat": chat_id, "after": after, "limit": limit})
+
+def line_rows(month: str, chat_id: int) -> Iterable[tuple]:
+    m0, m1 = month_range(month)
+    return stream_rows(_LINES_SQL, {"m0": m0, "m1": m1, "chat": chat_id}, chunk=REPORT_CHUNK)
+
+def report_caption(month: str, t: dict) -> str:
+    text = (
+        f"📊 Báo cáo tháng {user_month(month)}\n"
+        f"• Dây đang mở: {t['open_lines']} (đã đóng {t['closed_lines']}) · Mệnh giá: {int(t['open_contrib']):,} VND\n"
+        f"• Kỳ đến hạn trong tháng: {int(t['rounds_due'])} · đã nhập thăm: {int(t['rounds_bid'])}\n"
+        f"• Đóng trong tháng: {int(t['pay_count'])} lần · {int(t['pay_total']):,} VND\n"
+        f"• Dây mở — đã đóng: {int(t['paid_now']):,} VND · lãi nếu hốt kỳ này: {int(t['profit_now']):,} VND"
+    )
+    return text[:CAPTION_LIMIT]
+
+# ----- files -----
+def write_csv(header: Sequence[str], rows: Iterable[Sequence]) -> SpooledTemporaryFile:
+    f = SpooledTemporaryFile(max_size=REPORT_SPOOL_BYTES, mode="w+b")
+    f.write(codecs.BOM_UTF8)   # Excel opens UTF-8 CSV correctly only with a BOM
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(header)
+    for row in rows:
+        w.writerow(row)
+        if buf.tell() > 64 * 1024:
+            f.write(buf.getvalue().encode("utf-8")); buf.seek(0); buf.truncate()
+    f.write(buf.getvalue().encode("utf-8"))
+    f.seek(0)
+    return f
+
+def write_xlsx(header: Sequence[str], rows: Iterable[Sequence], title: str) -> SpooledTemporaryFile:
+    from openpyxl import Workbook      # optional; raises ImportError when missing
+    wb = Workbook(write_only=True)     # rows go straight to a temp file, not an in-memory sheet
+    ws = wb.create_sheet(title[:31])
+    ws.append(list(header))
+    for row in rows:
+        ws.append(list(row))
+    f = SpooledTemporaryFile(max_size=REPORT_SPOOL_BYTES, mode="w+b")
+    wb.save(f)
+    f.seek(0)
+    return f
+
+def build_export(month: str, chat_id: int, fmt: str = "csv") -> Tuple[SpooledTemporaryFile, str]:
+    """(file, filename) for one chat's month; falls back to CSV when openpyxl is missing."""
+    name = f"hui_{month}"
+    if fmt == "xlsx":
+        try:
+            import openpyxl  # noqa: F401
+        except ImportError:
+            fmt = "csv"
+    if fmt == "xlsx":
+        return write_xlsx(EXPORT_HEADER, line_rows(month, chat_id), month), f"{name}.xlsx"
+    return write_csv(EXPORT_HEADER, line_rows(month, chat_id)), f"{name}.csv"
+
+# ----- monthly cron -----
+def _send(chat_id: int, f, filename: str, caption: str) -> Tuple[str, float, str]:
+    """(outcome, retry_after, error) with outcome in ok | limited | fail."""
+    from adapter_huibot import send_document
+    try:
+        resp = send_document(chat_id, f, filename, caption)
+    except Exception as e:
+        return "limited", 5.0, repr(e)          # network: stop here, the next tick resumes
+    if resp.status_code == 200:
+        return "ok", 0.0, ""
+    try:
+        body = resp.json()
+    except Exception:
+        body = {}
+    if resp.status_code == 429 or resp.status_code >= 500:
+        return "limited", float((body.get("parameters") or {}).get("retry_after", 5)), body.get("description", "")
+    return "fail", 0.0, body.get("description") or resp.text[:200]   # blocked bot, chat gone
+
+def run_monthly(now: Optional[datetime] = None, force: bool = False, month: Optional[str] = None,
+                sleep=time.sleep) -> Dict[str, object]:
+    """Send last month's report to every chat that owns lines, once per month.
+
+    Due from the 1st at REPORT_HOUR; progress (last chat sent) is kept in configs so a
+    tick that runs out of time is resumed by the next one.
+    """
+    t0 = time.monotonic()
+    now = now or now_local()
+    month = month or previous_month(now)
+    stats = {"month": month, "chats": 0, "sent": 0, "failed": 0, "done": True}
+    if not force and now.day == 1 and now.hour < REPORT_HOUR:
+        stats.update(done=False, skipped="before REPORT_HOUR")
+        return stats
+    state = cfg_get(STATE_KEY, {}) or {}
+    if state.get("month") == month and state.get("done") and not force:
+        stats["skipped"] = "already sent"
+        return stats
+    after = state.get("after") if state.get("month") == month and not force else None
+    while stats["done"]:
+        totals = chat_totals(month, after=after)
+        if not totals:
+            break
+        for t in totals:
+            if time.monotonic() - t0 > REPORT_MAX_SECONDS:
+                stats["done"] = False
+                break
+            chat_id = int(t["chat_id"])
+            f, filename = build_export(month, chat_id)
+            try:
+                outcome, retry_after, err = _send(chat_id, f, filename, report_caption(month, t))
+                if outcome == "limited" and time.monotonic() - t0 + retry_after < REPORT_MAX_SECONDS:
+                    sleep(retry_after)
+                    f.seek(0)
+                    outcome, retry_after, err = _send(chat_id, f, filename, report_caption(month, t))
+            finally:
+                f.close()
+            if outcome == "limited":
+                stats["done"] = False
+                break
+            stats["chats"] += 1
+            if outcome == "ok":
+                stats["sent"] += 1
+            else:
+                stats["failed"] += 1
+                print(f"❌ Monthly report to {chat_id} failed: {err}")
+            after = chat_id
+            cfg_set(STATE_KEY, {"month": month, "after": after, "done": False})
+        if len(totals) < REPORT_BATCH:
+            break
+    if stats["done"]:
+        cfg_set(STATE_KEY, {"month": month, "after": after, "done": True})
+    stats["ms"] = round((time.monotonic() - t0) * 1000, 1)
+    return stats
@@ -0,0 +1,383 @@
+"""Benchmark harness for the webhook and cron endpoints.
+
+Drives api/index.py's Flask app (test client, no HTTP server) with synthetic
+Telegram updates against a local Postgres and scripts/fake_telegram.py, after
+seeding lines/rounds/payments at the requested scale. Reports p50/p99 latency and
+DB round trips per command (/tao, /tham, /tomtat, /hottot, /danhsach, /xuat) and the
+throughput of the reminders, outbox and monthly crons, and saves it all as JSON:
+
+    python scripts/bench.py                                  # 10k lines, embedded Postgres (pgserver)
+    python scripts/bench.py --lines 100000 --legs 100 --out bench/main.json
+    BENCH_DATABASE_URL=postgresql://localhost/huibot_bench python scripts/bench.py --reset
+    python scripts/bench.py --out bench/pr.json --compare bench/main.json   # exit 1 on regression
+    python scripts/bench.py --input bench/pr.json --compare bench/main.json # compare saved runs only
+
+Without BENCH_DATABASE_URL the database lives in an embedded server (`pip install
+pgserver`, data in --pgdata) and is recreated on every run. A BENCH_DATABASE_URL
+database must be empty unless --reset is given (which TRUNCATEs the bot's tables).
+Outbox pacing is raised to --outbox-rate msg/s so the cron numbers measure the
+bot, not Telegram's limits (the fake server does not enforce them either).
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "api"), os.path.dirname(os.path.abspath(__file__))]
+
+BENCH_DB = "huibot_bench"
+# commands run in a supergroup: group ids are negative, the case keyset cursors get wrong
+BENCH_CHAT = -1_001_000_000_001
+CHAT_BASE = 1000                       # other lines: private chats CHAT_BASE+n and supergroups -(GROUP_BASE+n)
+GROUP_BASE = 1_002_000_000_000
+BID_PCT = 5                            # every bid is 5% of M (lines are created with sàn 1%, trần 20%)
+COMMANDS = ("tao", "tham", "tomtat", "hottot", "danhsach", "xuat")
+BOT_TABLES = ("lines", "payments", "rounds", "line_summary", "round_schedule", "outbox",
+              "processed_updates", "configs")
+
+# ----- database -----
+def _database_url(args) -> str:
+    url = os.getenv("BENCH_DATABASE_URL", "").strip()
+    if url:
+        return url
+    import pgserver
+    import psycopg2
+    import psycopg2.extensions
+    srv = pgserver.get_server(args.pgdata, cleanup_mode=None)
+    admin = psycopg2.connect(srv.get_uri())
+    admin.autocommit = True
+    cur = admin.cursor()
+    cur.execute(f"DROP DATABASE IF EXISTS {BENCH_DB}")
+    cur.execute(f"CREATE DATABASE {BENCH_DB}")
+    admin.close()
+    return srv.get_uri(BENCH_DB)
+
+def _prepare(reset: bool):
+    from db_pg import ensure_schema, get_all, exec_sql
+    ensure_schema()
+    if reset:
+        exec_sql(f"TRUNCATE {', '.join(BOT_TABLES)} RESTART IDENTITY CASCADE")
+    elif get_all("SELECT 1 FROM lines LIMIT 1"):
+        sys.exit("bench: the database already has lines; pass --reset to TRUNCATE the bot's tables")
+
+# ----- seeding -----
+def seed(args, today: date) -> dict:
+    """lines in SQL-friendly batches, then rounds + payments for every elapsed round, then summaries."""
+    import psycopg2.extras
+    from db_pg import connection
+    from hui_bot_fresh import rebuild_line_summaries
+    rnd = random.Random(args.seed)
+    t0 = time.perf_counter()
+    rows = []
+    for i in range(args.lines):
+        n = rnd.randrange(args.chats)
+        chat = BENCH_CHAT if i < args.chat_lines else (-(GROUP_BASE + n) if n % 2 else CHAT_BASE + n)
+        period = rnd.choice((7, 30))
+        legs = rnd.randint(min(5, args.legs), args.legs)
+        done = rnd.randrange(legs)                        # rounds already bid
+        # mid-round today, so reminders only fire for the lines the cron phase makes due
+        start = today - timedelta(days=period * done + rnd.randint(1, period - 1))
+        contrib = rnd.randint(1, 50) * 100_000
+        rows.append((chat, f"L{i + 1}", period, start, legs, contrib, done))
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("CREATE TEMP TABLE _seed(chat_id BIGINT, name TEXT, period_days INT, start_date DATE, "
+                    "legs INT, contrib BIGINT, done INT)")
+        psycopg2.extras.execute_values(cur, "INSERT INTO _seed VALUES %s", rows, page_size=5000)
+        cur.execute("""
+            INSERT INTO lines(chat_id, name, period_days, start_date, legs, contrib, base_rate, cap_rate, thau_rate)
+            SELECT chat_id, name, period_days, start_date, legs, contrib, 1, 20, 5 FROM _seed ORDER BY name
+        """)
+        cur.execute("""
+            INSERT INTO rounds(line_id, k, bid, round_date)
+            SELECT l.id, g.k, l.contrib * %s / 100, l.start_date + (g.k - 1) * l.period_days
+            FROM lines l JOIN _seed s ON s.name = l.name
+            CROSS JOIN LATERAL generate_series(1, s.done) AS g(k)
+        """, (BID_PCT,))
+        cur.execute("""
+            INSERT INTO payments(line_id, pay_date, amount)
+            SELECT r.line_id, r.round_date, l.contrib - r.bid FROM rounds r JOIN lines l ON l.id = r.line_id
+        """)
+        cur.execute("DROP TABLE _seed")
+        cur.execute("ANALYZE")
+        cur.execute("SELECT (SELECT COUNT(*) FROM rounds), (SELECT COUNT(*) FROM payments)")
+        n_rounds, n_pays = cur.fetchone()
+        cur.close()
+    t1 = time.perf_counter()
+    summaries = rebuild_line_summaries(batch=1000)
+    t2 = time.perf_counter()
+    return {"lines": args.lines, "rounds": n_rounds, "payments": n_pays, "summaries": summaries,
+            "rows_ms": round((t1 - t0) * 1000), "summaries_ms": round((t2 - t1) * 1000)}
+
+# ----- driving the app -----
+class Driver:
+    def __init__(self, client, records: list):
+        self.client, self.records = client, records
+        self.update_id = int(time.time() * 1000) % 1_000_000_000   # unique across --reset runs
+
+    def command(self, text: str, chat_id: int = BENCH_CHAT):
+        self.update_id += 1
+        update = {"update_id": self.update_id,
+                  "message": {"message_id": self.update_id, "date": int(time.time()), "text": text,
+                              "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+                              "from": {"id": 42}}}
+        del self.records[:]
+        t0 = time.perf_counter()
+        resp = self.client.post("/api/webhook", json=update)
+        ms = (time.perf_counter() - t0) * 1000
+        rec = self.records[-1] if self.records else {}
+        body = resp.get_json(silent=True) or {}
+        # ❌ = error, 📂 = "no lines": every benchmarked chat owns lines
+        ok = resp.status_code == 200 and not str(body.get("text", "")).startswith(("❌", "📂"))
+        return ms, rec, ok, body
+
+    def cron(self, path: str):
+        t0 = time.perf_counter()
+        resp = self.client.get(path)
+        return (time.perf_counter() - t0) * 1000, resp.get_json(silent=True) or {}
+
+def _pct(values, q: float) -> float:
+    # nearest-rank percentile
+    s = sorted(values)
+    return s[max(0, min(len(s) - 1, math.ceil(q * len(s)) - 1))] if s else 0.0
+
+def _summarize(samples: list, errors: int) -> dict:
+    ms = [m for m, _ in samples]
+    queries = [r.get("db_queries", 0) for _, r in samples]
+    return {
+        "n": len(samples), "errors": errors,
+        "p50_ms": round(_pct(ms, 0.50), 2), "p90_ms": round(_pct(ms, 0.90), 2),
+        "p99_ms": round(_pct(ms, 0.99), 2), "max_ms": round(max(ms, default=0), 2),
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else 0,
+        "db_queries_mean": round(sum(queries) / len(queries), 2) if queries else 0,
+        "db_queries_max": max(queries, default=0),
+        "db_ms_p50": round(_pct([r.get("db_ms", 0) for _, r in samples], 0.50), 2),
+        "tg_calls_mean": round(sum(r.get("tg_calls", 0) for _, r in samples) / len(samples), 2) if samples else 0,
+    }
+
+def _bench_lines(limit: int):
+    from db_pg import get_all
+    return get_all("""
+        SELECT l.id, l.legs, l.contrib, COALESCE(MAX(r.k), 0) + 1 AS next_k
+        FROM lines l LEFT JOIN rounds r ON r.line_id = l.id
+        WHERE l.chat_id = %s AND l.status = 'OPEN'
+        GROUP BY l.id ORDER BY l.id LIMIT %s
+    """, (BENCH_CHAT, limit))
+
+def run_commands(driver: Driver, args) -> dict:
+    rnd = random.Random(args.seed + 1)
+    lines = _bench_lines(args.chat_lines)
+    ids = [int(r["id"]) for r in lines]
+    open_rounds = [r for r in lines if int(r["next_k"]) <= int(r["legs"])]
+    from hui_bot_fresh import now_local
+    from reports import previous_month, user_month
+    last_month = user_month(previous_month(now_local()))
+    texts = {
+        "tao":      lambda i: f"/tao B{i} tuần {(date.today() - timedelta(days=7 * i % 70)).strftime('%d-%m-%Y')} "
+                              f"{args.legs} 1000000 1 20 5",
+        "tomtat":   lambda i: f"/tomtat {rnd.choice(ids)}",
+        "hottot":   lambda i: f"/hottot {rnd.choice(ids)}",
+        "danhsach": lambda i: "/danhsach",
+        "xuat":     lambda i: f"/xuat {last_month}",
+    }
+
+    def tham(i):
+        # next unbid round of a bench-chat line (lines fill up and drop out of the rotation)
+        while open_rounds:
+            r = open_rounds[i % len(open_rounds)]
+            k = int(r["next_k"])
+            if k <= int(r["legs"]):
+                r["next_k"] = k + 1
+                return f"/tham {r['id']} {k} {int(r['contrib']) * BID_PCT // 100}"
+            open_rounds.remove(r)
+        return None
+    texts["tham"] = tham
+
+    for name in COMMANDS:                     # warm-up: imports, pool, plans, caches
+        for i in range(args.warmup):
+            text = texts[name](-1 - i)
+            if text:
+                driver.command(text)
+    results = {}
+    for name in COMMANDS:
+        samples, errors = [], 0
+        for i in range(args.iterations):
+            text = texts[name](i)
+            if text is None:
+                break
+            ms, rec, ok, body = driver.command(text)
+            samples.append((ms, rec))
+            if not ok:
+                errors += 1
+                if errors == 1:
+                    print(f"bench: /{name} failed: {body}", file=sys.stderr)
+        results[name] = _summarize(samples, errors)
+    return results
+
+def run_crons(driver: Driver, args, today: date) -> dict:
+    from db_pg import exec_sql, get_all
+    from reports import previous_month
+    from hui_bot_fresh import now_local
+    out = {}
+    # make every --due-every'th line due today: start on a round date, reminder time already passed
+    exec_sql("""
+        UPDATE lines SET start_date = %s::date - (period_days * (id %% legs))::int,
+                         remind_hour = 0, remind_min = 0, last_remind_iso = NULL
+        WHERE id %% %s = 0 AND status = 'OPEN'
+    """, (today, args.due_every))
+    ms, body = driver.cron("/api/cron/reminders")
+    out["reminders"] = {"ms": round(ms, 1), "due": body.get("due", 0), "messages": body.get("messages", 0),
+                        # selection + queueing only; the drain that follows is timed by the outbox numbers
+                        "lines_per_s": round(body.get("due", 0) / (body["ms"] / 1000), 1) if body.get("ms") else 0,
+                        "outbox": body.get("outbox", {}), "done": body.get("done")}
+    exec_sql("UPDATE outbox SET status='PENDING', not_before=NOW(), attempts=0")   # resend: outbox alone
+    sent, t0 = 0, time.perf_counter()
+    while True:
+        _, body = driver.cron("/api/cron/outbox")
+        sent += body.get("sent_rows", 0)
+        if body.get("done", True) and not get_all("SELECT 1 FROM outbox WHERE status='PENDING' LIMIT 1"):
+            break
+    secs = time.perf_counter() - t0
+    out["outbox"] = {"ms": round(secs * 1000, 1), "sent_rows": sent,
+                     "rows_per_s": round(sent / secs, 1) if secs else 0}
+    month = previous_month(now_local())
+    expected = get_all("SELECT COUNT(DISTINCT chat_id) AS n FROM lines WHERE chat_id IS NOT NULL")[0]["n"]
+    ms, body = driver.cron(f"/api/cron/monthly?force=1&month={month}")
+    out["monthly"] = {"ms": round(ms, 1), "month": month, "chats": body.get("chats", 0), "sent": body.get("sent", 0),
+                      "expected_chats": expected,
+                      "chats_per_s": round(body.get("chats", 0) / (ms / 1000), 1) if ms else 0,
+                      "done": body.get("done")}
+    if body.get("done") and body.get("chats", 0) != expected:
+        # every chat that owns lines (private and group) must get its report
+        print(f"bench: monthly reached {body.get('chats', 0)} of {expected} chats", file=sys.stderr)
+        out["monthly"]["errors"] = expected - body.get("chats", 0)
+    return out
+
+# ----- output -----
+def _meta(args) -> dict:
+    from db_pg import get_all
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit, "at": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "postgres": get_all("SHOW server_version")[0]["server_version"],
+            "database": "BENCH_DATABASE_URL" if os.getenv("BENCH_DATABASE_URL") else "pgserver",
+            "reply_mode": os.environ["REPLY_MODE"], "args": vars(args)}
+
+def print_report(result: dict):
+    print(f"seed: {result['seed']}")
+    print(f"{'command':<10} {'n':>5} {'err':>4} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'db q':>6} {'db ms':>7}")
+    for name, r in result["commands"].items():
+        print(f"/{name:<9} {r['n']:>5} {r['errors']:>4} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['max_ms']:>8} "
+              f"{r['db_queries_mean']:>6} {r['db_ms_p50']:>7}")
+    for name, r in result["crons"].items():
+        print(f"cron {name}: {r}")
+
+def compare(old: dict, new: dict, threshold: float) -> int:
+    """Print per-command deltas; returns the number of regressions (latency > threshold x, more queries)."""
+    bad = 0
+    print(f"{'command':<10} {'p50 ms':>17} {'p99 ms':>17} {'db q':>13}")
+    for name, n in new["commands"].items():
+        o = old.get("commands", {}).get(name)
+        if not o:
+            continue
+        flags = []
+        for key in ("p50_ms", "p99_ms"):
+            if o[key] and n[key] > o[key] * threshold:
+                flags.append(key)
+        if n["db_queries_mean"] > o["db_queries_mean"] + 0.01:
+            flags.append("db_queries")
+        if n["errors"] > o["errors"]:
+            flags.append("errors")
+        bad += bool(flags)
+        print(f"/{name:<9} {o['p50_ms']:>7} → {n['p50_ms']:<7} {o['p99_ms']:>7} → {n['p99_ms']:<7} "
+              f"{o['db_queries_mean']:>5} → {n['db_queries_mean']:<5}" + (f"  REGRESSION {flags}" if flags else ""))
+    for name, n in new.get("crons", {}).items():
+        o = old.get("crons", {}).get(name)
+        if n.get("errors"):
+            bad += 1
+            print(f"cron {name}: {n['errors']} error(s)  REGRESSION")
+        if o:
+            rate = next((k for k in n if k.endswith("_per_s")), None)
+            if rate and o.get(rate) and n[rate] * threshold < o[rate]:
+                bad += 1
+                print(f"cron {name}: {rate} {o[rate]} → {n[rate]}  REGRESSION")
+            elif rate:
+                print(f"cron {name}: {rate} {o.get(rate)} → {n[rate]}")
+    print(f"{old.get('meta', {}).get('commit', '?')} → {new.get('meta', {}).get('commit', '?')}: "
+          f"{bad} regression(s) at threshold {threshold}x")
+    return bad
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--lines", type=int, default=10_000, help="lines to seed (default 10000)")
+    ap.add_argument("--legs", type=int, default=100, help="max legs per line (default 100)")
+    ap.add_argument("--chats", type=int, default=1000, help="chats owning the other lines (default 1000)")
+    ap.add_argument("--chat-lines", type=int, default=200, help="lines owned by the benchmarked chat")
+    ap.add_argument("--iterations", type=int, default=200, help="timed requests per command")
+    ap.add_argument("--warmup", type=int, default=5, help="untimed requests per command first")
+    ap.add_argument("--due-every", type=int, default=10, help="every Nth line is due for the reminder cron")
+    ap.add_argument("--outbox-rate", type=float, default=10_000, help="outbox msg/s during the bench")
+    ap.add_argument("--reply-mode", choices=("inline", "api"), default="inline")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--pgdata", default=os.path.join(tempfile.gettempdir(), "huibot-bench-pgdata"))
+    ap.add_argument("--reset", action="store_true", help="TRUNCATE the bot's tables in BENCH_DATABASE_URL")
+    ap.add_argument("--out", help="write the result JSON here")
+    ap.add_argument("--input", help="skip the run; load this result JSON (use with --compare)")
+    ap.add_argument("--compare", help="baseline result JSON; exit 1 on regressions")
+    ap.add_argument("--threshold", type=float, default=1.25, help="latency ratio that counts as a regression")
+    args = ap.parse_args()
+
+    if args.input:
+        with open(args.input) as f:
+            result = json.load(f)
+    else:
+        # configuration is read at import time, so set it before touching the bot's modules
+        from fake_telegram import FakeTelegram
+        fake = FakeTelegram(limits=False)
+        fake.start()
+        os.environ.update({
+            "DATABASE_URL": _database_url(args), "DB_SSLMODE": os.getenv("BENCH_DB_SSLMODE", "prefer"),
+            "TELEGRAM_TOKEN": os.getenv("TELEGRAM_TOKEN") or "bench", "TELEGRAM_API_BASE": fake.base_url,
+            "REPLY_MODE": args.reply_mode, "METRICS_LOG": "0", "CRON_SECRET": "",
+            "OUTBOX_GLOBAL_RATE": str(args.outbox_rate), "OUTBOX_CHAT_RATE": str(args.outbox_rate),
+        })
+        import metrics
+        import index
+        from hui_bot_fresh import now_local
+        records = []
+        metrics.add_sink(records.append)
+        _prepare(args.reset)
+        today = now_local().date()
+        result = {"seed": seed(args, today)}
+        driver = Driver(index.app.test_client(), records)
+        result["commands"] = run_commands(driver, args)
+        result["crons"] = run_crons(driver, args, today)
+        result["telegram_calls"] = len(fake.calls)
+        result["meta"] = _meta(args)
+        fake.stop()
+        print_report(result)
+        if args.out:
+            os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+            with open(args.out, "w") as f:
+                json.dump(result, f, indent=2, default=str)
+            print(f"saved {args.out}")
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(json.load(f), result, args.threshold) else 0
+    if args.input:
+        print_report(result)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
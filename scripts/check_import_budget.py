@@ -0,0 +1,75 @@
+"""Cold-import budget for the Vercel entry point.
+
+Imports api/index.py in a fresh interpreter (what a Vercel cold start pays
+before /api/webhook can answer) and exits non-zero when it takes longer than
+the budget. Run it in CI after dependency or import changes:
+
+    python scripts/check_import_budget.py            # default budget
+    IMPORT_BUDGET_MS=250 python scripts/check_import_budget.py --runs 5
+
+The best of --runs attempts is compared so a noisy machine does not fail the
+check; -v prints the slowest modules from `python -X importtime`.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BUDGET_MS = 300.0
+
+# Modules that must stay off the cold path (pulled in lazily by the commands that need them)
+FORBIDDEN = ("pandas", "numpy", "telegram", "psycopg2", "httpx")
+
+_CHILD = r"""
+import sys, time, json
+sys.path[:0] = [{root!r}, {api!r}]
+t0 = time.perf_counter()
+import index
+ms = (time.perf_counter() - t0) * 1000
+print(json.dumps({{"ms": ms, "modules": sorted(sys.modules)}}))
+"""
+
+def measure_once() -> dict:
+    import json
+    code = _CHILD.format(root=ROOT, api=os.path.join(ROOT, "api"))
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=ROOT)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def slowest_imports(limit: int = 15):
+    code = _CHILD.format(root=ROOT, api=os.path.join(ROOT, "api"))
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=ROOT)
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cum_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(cum_us), name.strip()))
+    return sorted(rows, reverse=True)[:limit]
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", DEFAULT_BUDGET_MS)))
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args(argv)
+
+    results = [measure_once() for _ in range(max(1, args.runs))]
+    best = min(r["ms"] for r in results)
+    leaked = sorted({m.split(".")[0] for m in results[0]["modules"]} & set(FORBIDDEN))
+
+    print(f"cold import api/index.py: best {best:.1f} ms of {len(results)} (budget {args.budget_ms:.0f} ms)")
+    if args.verbose:
+        for cum_us, name in slowest_imports():
+            print(f"  {cum_us/1000:8.1f} ms  {name}")
+    failed = False
+    if leaked:
+        print("FAIL: heavy modules imported at cold start: " + ", ".join(leaked))
+        failed = True
+    if best > args.budget_ms:
+        print("FAIL: cold import over budget")
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+"""Local stand-in for the Telegram Bot API.
+
+Accepts POST/GET /bot<token>/<method>, records every call and enforces the same
+limits as Telegram (global msg/s and per-chat msg/s) by answering 429 with
+parameters.retry_after. Point the bot at it with TELEGRAM_API_BASE:
+
+    python scripts/fake_telegram.py --port 8081
+    TELEGRAM_API_BASE=http://127.0.0.1:8081 python -c "import outbox; print(outbox.drain())"
+
+FakeTelegram(...).start() runs it in-process on a background thread.
+"""
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+class FakeTelegram:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, global_rate: float = 30.0,
+                 chat_rate: float = 1.0, latency_ms: float = 0.0, limits: bool = True):
+        self.global_rate, self.chat_rate = global_rate, chat_rate
+        self.latency = latency_ms / 1000.0
+        self.limits = limits
+        self.calls = []                         # [(monotonic, method, payload)]
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._global = deque()
+        self._per_chat = defaultdict(deque)
+        self._message_id = 0
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _payload(self):
+                q = dict(parse_qsl(urlparse(self.path).query))
+                n = int(self.headers.get("Content-Length") or 0)
+                if n:
+                    raw = self.rfile.read(n)
+                    ctype = self.headers.get("Content-Type", "")
+                    if ctype.startswith("application/json"):
+                        q.update(json.loads(raw or b"{}"))
+                    elif ctype.startswith("application/x-www-form-urlencoded"):
+                        q.update(parse_qsl(raw.decode()))
+                    else:
+                        q["_body_bytes"] = len(raw)  # multipart uploads: size only
+                return q
+
+            def _handle(self):
+                parts = urlparse(self.path).path.strip("/").split("/")
+                method = parts[-1] if len(parts) >= 2 else ""
+                status, body = owner.handle(method, self._payload())
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = _handle
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _over_limit(self, chat_id, now: float):
+        # sliding one-second windows, like Telegram's flood control (with a little slack for
+        # request jitter; the real limits are approximate too)
+        for q, rate in ((self._global, self.global_rate), (self._per_chat[chat_id], self.chat_rate)):
+            while q and now - q[0] >= 0.95:
+                q.popleft()
+            if len(q) >= max(1, int(rate)):
+                return max(1, int(1.0 - (now - q[0])) + 1)
+        return 0
+
+    def handle(self, method: str, payload: dict):
+        if self.latency:
+            time.sleep(self.latency)
+        now = time.monotonic()
+        with self._lock:
+            if method in ("sendMessage", "sendDocument", "editMessageText") and self.limits:
+                retry = self._over_limit(payload.get("chat_id"), now)
+                if retry:
+                    self.rejected += 1
+                    return 429, {"ok": False, "error_code": 429,
+                                 "description": f"Too Many Requests: retry after {retry}",
+                                 "parameters": {"retry_after": retry}}
+                self._global.append(now)
+                self._per_chat[payload.get("chat_id")].append(now)
+            self.calls.append((now, method, payload))
+            self._message_id += 1
+            mid = self._message_id
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "username": "fake_bot"}}
+        return 200, {"ok": True, "result": {"message_id": mid, "chat": {"id": payload.get("chat_id")}}}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def main():
+    ap = argparse.ArgumentParser(description="Local fake Telegram Bot API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--global-rate", type=float, default=30.0)
+    ap.add_argument("--chat-rate", type=float, default=1.0)
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--no-limits", action="store_true")
+    args = ap.parse_args()
+    fake = FakeTelegram(args.host, args.port, args.global_rate, args.chat_rate, args.latency_ms, not args.no_limits)
+    print(f"fake Telegram Bot API on {fake.base_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules live at the repo root (no package); nothing here needs a database
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,110 @@
+# /tham batch and /nhap CSV: parsing, validation and the all-or-nothing reply.
+import asyncio
+
+import pytest
+
+import hui_bot_fresh as bot
+from hui_bot_fresh import parse_import_csv, validate_import
+
+LINE = {"id": 7, "legs": 12, "contrib": 1_000_000, "base_rate": 10, "cap_rate": 50}
+
+# ----- parse_import_csv -----
+def test_header_known_names_any_order():
+    text = "ngay,tien,ky,loai\n01-02-2025,200000,1,tham\n"
+    assert parse_import_csv(text) == [(2, "tham", "1", "200000", "01-02-2025")]
+
+@pytest.mark.parametrize("header", ["loai,k,tham,date", "Loại,Kỳ,Số tiền,Ngày", "type,k,amount,date"])
+def test_header_aliases(header):
+    rows = parse_import_csv(header + "\ndong,,500000,2025-02-01\n")
+    assert rows == [(2, "dong", "", "500000", "2025-02-01")]
+
+def test_no_header_takes_default_order():
+    # the first row is data even though "tham" is also a column alias
+    rows = parse_import_csv("tham,1,200000,01-02-2025\ntham,2,250000,\n")
+    assert rows == [(1, "tham", "1", "200000", "01-02-2025"), (2, "tham", "2", "250000", "")]
+
+@pytest.mark.parametrize("sep", [";", "\t"])
+def test_delimiters(sep):
+    text = sep.join(["loai", "ky", "tien", "ngay"]) + "\n" + sep.join(["tham", "3", "300000", "01-03-2025"]) + "\n"
+    assert parse_import_csv(text) == [(2, "tham", "3", "300000", "01-03-2025")]
+
+def test_blank_rows_skipped_and_numbered_by_file_line():
+    rows = parse_import_csv("loai,ky,tien,ngay\n\ntham,1,200000,\n,,,\ndong,,100000,01-01-2025\n")
+    assert [r[0] for r in rows] == [3, 5]
+
+# ----- validate_import -----
+def test_iso_and_dmy_dates():
+    rounds, pays, errors = validate_import(LINE, [
+        (1, "tham", "1", "200000", "2025-02-01"),
+        (2, "dong", "", "800000", "01-02-2025"),
+        (3, "dong", "", "800k", "1/3/25"),
+    ])
+    assert errors == []
+    assert rounds == {1: (200_000, "2025-02-01")}
+    assert pays == [("2025-02-01", 800_000), ("2025-03-01", 800_000)]
+
+def test_duplicate_ky_last_row_wins():
+    rounds, _, errors = validate_import(LINE, [
+        (1, "tham", "2", "200000", ""),
+        (2, "Thăm", "2", "300k", "01-03-2025"),
+    ])
+    assert errors == []
+    assert rounds == {2: (300_000, "2025-03-01")}
+
+def test_errors_per_row():
+    _, _, errors = validate_import(LINE, [
+        (1, "tham", "0", "200000", ""),          # kỳ out of range
+        (2, "tham", "x", "200000", ""),          # kỳ not a number
+        (3, "tham", "1", "50000", ""),           # below the floor (10% of M)
+        (4, "dong", "", "100000", ""),           # payment without a date
+        (5, "đóng", "", "0", "01-01-2025"),      # zero payment
+        (6, "hot", "1", "100000", ""),           # unknown kind
+        (7, "tham", "1", "", ""),                # no amount
+        (8, "tham", "1", "200000", "31-02-2025"),  # no such day
+        (9, "tham", "1", "200000", ""),          # fine
+    ])
+    assert [no for no, _ in errors] == [1, 2, 3, 4, 5, 6, 7, 8]
+
+# ----- _import_and_reply -----
+class _Msg:
+    def __init__(self):
+        self.sent = []
+    async def reply_text(self, text, **kwargs):
+        self.sent.append(text)
+
+class _Upd:
+    def __init__(self):
+        self.message = _Msg()
+
+def _reply(monkeypatch, rows, write_result=()):
+    written = []
+    def fake_write(line_id, rounds, pays):
+        written.append((line_id, rounds, pays))
+        return list(write_result)
+    monkeypatch.setattr(bot, "write_import", fake_write)
+    upd = _Upd()
+    asyncio.run(bot._import_and_reply(upd, LINE, rows))
+    return written, upd.message.sent
+
+def test_any_bad_row_writes_nothing(monkeypatch):
+    written, sent = _reply(monkeypatch, [
+        (2, "tham", "1", "200000", ""),
+        (3, "tham", "99", "200000", ""),
+    ])
+    assert written == []
+    assert sent[0].startswith("❌ Chưa nhập gì — 1/2 dòng lỗi")
+    assert "dòng 3" in sent[0]
+
+def test_good_batch_written_once(monkeypatch):
+    written, sent = _reply(monkeypatch, [
+        (2, "tham", "1", "200000", ""),
+        (3, "dong", "", "800000", "01-02-2025"),
+    ])
+    assert written == [(7, {1: (200_000, None)}, [("2025-02-01", 800_000)])]
+    assert sent[0].startswith("✅ Đã nhập dây #7")
+
+def test_resent_payments_rejected(monkeypatch):
+    _, sent = _reply(monkeypatch, [(2, "dong", "", "800000", "01-02-2025")],
+                     write_result=[("2025-02-01", 800_000)])
+    assert sent[0].startswith("❌ Chưa nhập gì — 1 khoản đóng đã có")
+    assert "01-02-2025 · 800,000 VND" in sent[0]
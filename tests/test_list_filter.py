@@ -0,0 +1,47 @@
+# /danhsach [mo|dong]: accented and English spellings, usage reply for anything else.
+import asyncio
+
+import pytest
+
+import hui_bot_fresh as bot
+
+class _Msg:
+    def __init__(self):
+        self.sent = []
+    async def reply_text(self, text, **kwargs):
+        self.sent.append(text)
+
+class _Chat:
+    id = -100123
+
+class _Upd:
+    def __init__(self):
+        self.message = _Msg()
+        self.effective_chat = _Chat()
+
+class _Ctx:
+    def __init__(self, args):
+        self.args = args
+
+def _run(monkeypatch, args):
+    codes = []
+    def fake_view(chat_id, code="all", before_id=None):
+        codes.append(code)
+        return "list", None
+    monkeypatch.setattr(bot, "list_view", fake_view)
+    upd = _Upd()
+    asyncio.run(bot.cmd_list(upd, _Ctx(args)))
+    return codes, upd.message.sent
+
+@pytest.mark.parametrize("arg,code", [
+    (None, "all"), ("mo", "mo"), ("mở", "mo"), ("Open", "mo"),
+    ("dong", "dong"), ("đóng", "dong"), ("ĐÓNG", "dong"), ("closed", "dong"),
+])
+def test_filters(monkeypatch, arg, code):
+    codes, sent = _run(monkeypatch, [arg] if arg else [])
+    assert codes == [code] and sent == ["list"]
+
+def test_unknown_filter_answers_usage(monkeypatch):
+    codes, sent = _run(monkeypatch, ["xyz"])
+    assert codes == []
+    assert sent == ["❌ Cú pháp: /danhsach [mo|dong]"]
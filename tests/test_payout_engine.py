@@ -0,0 +1,77 @@
+# payout_engine must give exactly what the per-k helpers in hui_bot_fresh give
+# (payout_at_k / paid_so_far_if_win_at_k / compute_profit_var), on every path.
+import random
+
+import pytest
+
+import payout_engine
+from payout_engine import best_k, best_k_many, payout_table
+from hui_bot_fresh import compute_profit_var
+
+def _random_lines(n, seed=20251018):
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        N = rnd.choice([1, 1, 2, 3]) if i % 10 == 0 else rnd.randint(1, 60)
+        M = rnd.choice([100_000, 500_000, 1_000_000, 2_000_000, rnd.randint(1, 10_000_000)])
+        thau = rnd.choice([0, 100, 0.0, 2.5, rnd.uniform(0, 100)])
+        lo, hi = sorted((rnd.uniform(0, 100), rnd.uniform(0, 100)))
+        line = {"contrib": M, "legs": N, "thau_rate": thau, "base_rate": lo, "cap_rate": hi}
+        # some rounds without a bid yet, some past the last filled one
+        bids = {k: rnd.randint(int(M * lo / 100), int(M * hi / 100))
+                for k in range(1, N + 1) if rnd.random() < 0.6}
+        out.append((line, bids))
+    return out
+
+LINES = _random_lines(3000)
+
+def _loop_best(line, bids, metric):
+    # the original O(N^2) loop over compute_profit_var
+    bestk, bestkey, bestinfo = 1, -1e18, None
+    for k in range(1, int(line["legs"]) + 1):
+        p, r, po, paid = compute_profit_var(line, k, bids)
+        key = r if metric == "roi" else p
+        if key > bestkey:
+            bestk, bestkey, bestinfo = k, key, (p, r, po, paid)
+    return bestk, bestinfo
+
+def _as_list(bids, N):
+    # LineSnapshot.bids form: index k, None for a round without a bid
+    return [None] + [bids.get(k) for k in range(1, N + 1)]
+
+def test_table_rows_match_per_k_helpers():
+    for line, bids in LINES:
+        table = payout_table(line, bids)
+        for k in range(1, int(line["legs"]) + 1):
+            assert table.row(k) == compute_profit_var(line, k, bids)
+
+def test_list_bids_same_as_dict_bids():
+    for line, bids in LINES:
+        a = payout_table(line, bids)
+        b = payout_table(line, _as_list(bids, int(line["legs"])))
+        assert (a.payout, a.paid, a.profit, a.roi) == (b.payout, b.paid, b.profit, b.roi)
+
+@pytest.mark.parametrize("metric", ["roi", "lai"])
+def test_best_k_matches_loop(metric):
+    for line, bids in LINES:
+        assert best_k(line, bids, metric) == _loop_best(line, bids, metric)
+
+@pytest.mark.parametrize("metric", ["roi", "lai"])
+def test_best_k_many_python_path(monkeypatch, metric):
+    monkeypatch.setattr(payout_engine, "NUMPY_MIN_CELLS", float("inf"))
+    expected = [_loop_best(line, bids, metric) for line, bids in LINES]
+    assert best_k_many(LINES, metric) == expected
+
+@pytest.mark.parametrize("metric", ["roi", "lai"])
+def test_best_k_many_numpy_path(monkeypatch, metric):
+    pytest.importorskip("numpy")
+    monkeypatch.setattr(payout_engine, "NUMPY_MIN_CELLS", 0)
+    items = [(line, bids if i % 2 else _as_list(bids, int(line["legs"]))) for i, (line, bids) in enumerate(LINES)]
+    expected = [_loop_best(line, bids, metric) for line, bids in LINES]
+    got = best_k_many(items, metric)
+    assert got == expected
+    # plain Python types, like the scalar path
+    assert all(type(v) in (int, float) for _, info in got for v in info)
+
+def test_best_k_many_empty():
+    assert best_k_many([]) == []